@@ -126,7 +126,11 @@ class AddLayerDialog(QDialog):
                                 epsg = int(vals[10])
                             except Exception as e:
                                 i = 0
-                            serviceInfo = TileLayerDefinition(title, attribution, url, yOriginTop, zmin, zmax, bbox, epsg)
+                            oversampling = None
+                            if nvals > 11 and vals[11]:
+                                oversampling = TileLayerDefinition.parseOversampling(vals[11])
+                            serviceInfo = TileLayerDefinition(title, attribution, url, yOriginTop, zmin, zmax, bbox, epsg,
+                                                              oversampling)
             except:
                 QgsMessageLog.logMessage(self.tr("Invalid line format: {} line {}").format(basename, i + 1),
                                          self.tr("TileLayerPlugin"))
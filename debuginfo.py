@@ -20,7 +20,7 @@
  ***************************************************************************/
 """
 from PyQt4.QtCore import Qt, QPoint, QPointF, QRect, QRectF, qDebug
-from qgis.core import QGis, QgsCoordinateTransform, QgsGeometry, QgsPoint, QgsRectangle
+from qgis.core import QGis, QgsGeometry, QgsPoint, QgsRectangle
 
 def drawDebugInformation(layer, renderContext, zoom, xmin, ymin, xmax, ymax):
   self = layer
@@ -54,6 +54,7 @@ def drawDebugInformation(layer, renderContext, zoom, xmin, ymin, xmax, ymax):
   lines.append(" deviceSize (pixel): %f, %f" % (device.width(), device.height()))
   lines.append(" logicalDpi: %f, %f" % (device.logicalDpiX(), device.logicalDpiY()))
   lines.append(" outputDpi: %f" % mapSettings.outputDpi())
+  lines.append(" zoom policy: %d, device pixel ratio: %f" % (self.plugin.zoomPolicy, self.devicePixelRatio(renderContext)))
   lines.append(" mapToPixel: %s" % map2pixel.showParameters())
 
   mupp = map2pixel.mapUnitsPerPixel()
@@ -66,7 +67,7 @@ def drawDebugInformation(layer, renderContext, zoom, xmin, ymin, xmax, ymax):
 
     cx, cy = 0.5 * viewport.width(), 0.5 * viewport.height()
     geometry = QgsGeometry.fromPolyline([map2pixel.toMapCoordinatesF(cx - 0.5, cy), map2pixel.toMapCoordinatesF(cx + 0.5, cy)])
-    geometry.transform(QgsCoordinateTransform(transform.destCRS(), transform.sourceCrs()))    # project CRS to layer CRS (EPSG:3857)
+    geometry.transform(self.plugin.transformCache.transform(transform.destCRS(), transform.sourceCrs()))    # project CRS to layer CRS (EPSG:3857)
     mpp = geometry.length()
     lines.append(" meters per pixel (calc center pixel): %f" % mpp)
 
@@ -76,6 +77,26 @@ def drawDebugInformation(layer, renderContext, zoom, xmin, ymin, xmax, ymax):
   scaleX, scaleY = self.getScaleToVisibleExtent(renderContext)
   lines.append(" scale: %f, %f" % (scaleX, scaleY))
 
+  for name, cache in [("memory cache", self.plugin.tileCache), ("image cache", self.plugin.imageCache)]:
+    stats = cache.stats()
+    lines.append(" %s: %d tiles, %d / %d KB, hits: %d, misses: %d, evictions: %d" % (name, stats["entries"], stats["bytes"] / 1024, stats["maxBytes"] / 1024,
+                                                                                   stats["hits"], stats["misses"], stats["evictions"]))
+  stats = self.plugin.reprojectionCache.stats()
+  lines.append(" reprojection cache: %d chunks, %d / %d KB, hits: %d, misses: %d, evictions: %d" % (stats["entries"], stats["bytes"] / 1024, stats["maxBytes"] / 1024,
+                                                                                                  stats["hits"], stats["misses"], stats["evictions"]))
+  stats = self.plugin.downloadPool.stats()
+  lines.append(" download pool: %d requests, running: %d, coalesced: %d, preempted: %d, errors: %d, cache hits: %d, %d KB" % (stats["requests"], stats["running"], stats["coalesced"],
+                                                                                                                             stats["preempted"], stats["errors"], stats["cacheHits"], stats["bytes"] / 1024))
+  lines.append(" retries: %d, failed fast: %d, not found: %d, open circuits: %s" % (stats["retries"], stats["failedFast"], stats["notFound"], ", ".join(stats["openCircuits"]) or "none"))
+  stats = self.plugin.tileDecoder.stats()
+  lines.append(" tile decoder: %d threads, active: %d, pending: %d, decoded: %d, failed: %d" % (stats["threads"], stats["active"], stats["pending"], stats["decoded"], stats["failed"]))
+  stats = self.plugin.negativeCache.stats()
+  lines.append(" negative cache: %d tiles, ttl: %d s, hits: %d, misses: %d" % (stats["entries"], stats["ttl"], stats["hits"], stats["misses"]))
+  store = self.diskStore()
+  if store:
+    stats = store.stats()
+    lines.append(" disk cache: %d tiles, %d / %d KB, %d missing tiles" % (stats["entries"], stats["bytes"] / 1024, stats["maxBytes"] / 1024, stats["missing"]))
+
   # draw information
   textRect = painter.boundingRect(QRect(QPoint(0, 0), viewport.size()), Qt.AlignLeft, "Q")
   for i, line in enumerate(lines):
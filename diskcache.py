@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ DiskCache
+   persistent tile store which is independent of the QGIS network cache
+                              -------------------
+        begin                : 2012-12-16
+        copyright            : (C) 2013 by Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from PyQt4.QtCore import QByteArray, qDebug
+
+debug_mode = 0
+
+
+class DiskTileStore:
+    """A SQLite file that stores tiles of a service. Table layout is similar to MBTiles,
+    but tile_row is the row number of the service (not flipped) and each tile has
+    expiration and last access time (seconds since the epoch), and validators (ETag and
+    Last-Modified) for conditional requests.
+    Tiles which do not exist on the server are recorded in missing_tiles table until they expire."""
+
+    # fraction of the size limit to which the store is shrunk when the limit is exceeded
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, filename, serviceUrl, maxBytes):
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+                        "tile_data BLOB, size INTEGER, expires INTEGER, accessed INTEGER, etag TEXT, last_modified TEXT, "
+                        "PRIMARY KEY (zoom_level, tile_column, tile_row))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS missing_tiles (zoom_level INTEGER, tile_column INTEGER, "
+                        "tile_row INTEGER, expires INTEGER, PRIMARY KEY (zoom_level, tile_column, tile_row))")
+        self.db.execute("INSERT OR REPLACE INTO metadata VALUES ('serviceUrl', ?)", (serviceUrl,))
+        self.db.commit()
+
+        self._bytes = self.db.execute("SELECT IFNULL(SUM(size), 0) FROM tiles").fetchone()[0]
+
+    def getRange(self, zoom, xmin, ymin, xmax, ymax, tiles=None, stale=None):
+        """returns a dict of valid (not expired) tiles in the range: {(x, y): QByteArray}.
+        if tiles (a collection of (x, y)) is given, tiles not in it are excluded from the result.
+        if stale (a dict) is given, expired tiles are added to it: {(x, y): (QByteArray, etag, lastModified)}"""
+        now = int(time.time())
+        sql = "SELECT tile_column, tile_row, tile_data, expires, etag, last_modified FROM tiles WHERE zoom_level=? AND " \
+              "tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"
+        params = (zoom, xmin, xmax, ymin, ymax)
+        if stale is None:
+            sql += " AND expires > ?"
+            params += (now,)
+
+        with self._lock:
+            rows = self.db.execute(sql, params).fetchall()
+            found = {}
+            accessed = []
+            for x, y, data, expires, etag, lastModified in rows:
+                if tiles is not None and (x, y) not in tiles:
+                    continue
+                if expires > now:
+                    found[(x, y)] = QByteArray(str(data))
+                else:
+                    stale[(x, y)] = (QByteArray(str(data)), etag, lastModified)
+                accessed.append((now, zoom, x, y))
+
+            if accessed:
+                self.db.executemany("UPDATE tiles SET accessed=? WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                    accessed)
+                self.db.commit()
+        return found
+
+    def tilesInRange(self, zoom, xmin, ymin, xmax, ymax):
+        """returns a set of (x, y) of valid tiles in the range"""
+        with self._lock:
+            rows = self.db.execute("SELECT tile_column, tile_row FROM tiles WHERE zoom_level=? AND "
+                                   "tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ? AND expires > ?",
+                                   (zoom, xmin, xmax, ymin, ymax, int(time.time()))).fetchall()
+        return set(rows)
+
+    def getMissing(self, zoom, xmin, ymin, xmax, ymax, tiles=None):
+        """returns a dict of expiration time of tiles which are known not to exist: {(x, y): expires}"""
+        with self._lock:
+            rows = self.db.execute("SELECT tile_column, tile_row, expires FROM missing_tiles WHERE zoom_level=? AND "
+                                   "tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ? AND expires > ?",
+                                   (zoom, xmin, xmax, ymin, ymax, int(time.time()))).fetchall()
+        return dict(((x, y), expires) for x, y, expires in rows if tiles is None or (x, y) in tiles)
+
+    def putMissing(self, tiles):
+        """tiles: a list of (zoom, x, y, expires)"""
+        if not tiles:
+            return
+        with self._lock:
+            self.db.execute("DELETE FROM missing_tiles WHERE expires <= ?", (int(time.time()),))
+            self.db.executemany("INSERT OR REPLACE INTO missing_tiles VALUES (?, ?, ?, ?)", tiles)
+
+            # tiles which have been removed from the server
+            for zoom, x, y, _ in tiles:
+                old = self.db.execute("SELECT size FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                      (zoom, x, y)).fetchone()
+                if old:
+                    self._bytes -= old[0]
+                    self.db.execute("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?", (zoom, x, y))
+            self.db.commit()
+
+    def updateExpiration(self, tiles):
+        """update expiration of tiles which have not been modified. tiles: a list of (zoom, x, y, expires, etag, lastModified).
+        validators which are None are not updated."""
+        if not tiles:
+            return
+        now = int(time.time())
+        with self._lock:
+            self.db.executemany("UPDATE tiles SET expires=?, accessed=?, etag=IFNULL(?, etag), "
+                                "last_modified=IFNULL(?, last_modified) WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                [(expires, now, etag, lastModified, zoom, x, y)
+                                 for zoom, x, y, expires, etag, lastModified in tiles])
+            self.db.commit()
+
+    def putTiles(self, tiles):
+        """tiles: a list of (zoom, x, y, data, expires, etag, lastModified)"""
+        now = int(time.time())
+        rows = []
+        for zoom, x, y, data, expires, etag, lastModified in tiles:
+            if expires <= now and not (etag or lastModified):
+                continue    # tiles which cannot be revalidated are useless once expired
+            blob = str(data)
+            rows.append((zoom, x, y, sqlite3.Binary(blob), len(blob), expires, now, etag, lastModified))
+        if not rows:
+            return
+
+        with self._lock:
+            for zoom, x, y, _, size, _, _, _, _ in rows:
+                old = self.db.execute("SELECT size FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                      (zoom, x, y)).fetchone()
+                if old:
+                    self._bytes -= old[0]
+                self._bytes += size
+            self.db.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, size, expires, "
+                                "accessed, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.executemany("DELETE FROM missing_tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                [row[:3] for row in rows])
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        if self._bytes <= self.maxBytes:
+            return
+        target = self.maxBytes * self.EVICTION_TARGET
+
+        # expired tiles are removed first, then least recently used ones
+        now = int(time.time())
+        removed = self.db.execute("SELECT IFNULL(SUM(size), 0) FROM tiles WHERE expires <= ?", (now,)).fetchone()[0]
+        self.db.execute("DELETE FROM tiles WHERE expires <= ?", (now,))
+        self._bytes -= removed
+
+        rowids = []
+        for rowid, size in self.db.execute("SELECT rowid, size FROM tiles ORDER BY accessed"):
+            if self._bytes <= target:
+                break
+            rowids.append((rowid,))
+            self._bytes -= size
+        self.db.executemany("DELETE FROM tiles WHERE rowid=?", rowids)
+        self.log("DiskTileStore evicted: %s, %d bytes" % (self.filename, self._bytes))
+
+    def setMaxBytes(self, maxBytes):
+        with self._lock:
+            self.maxBytes = maxBytes
+            self._evict()
+            self.db.commit()
+
+    def clear(self):
+        with self._lock:
+            self.db.execute("DELETE FROM tiles")
+            self.db.execute("DELETE FROM missing_tiles")
+            self.db.commit()
+            self._bytes = 0
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def stats(self):
+        with self._lock:
+            count = self.db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+            missing = self.db.execute("SELECT COUNT(*) FROM missing_tiles WHERE expires > ?",
+                                      (int(time.time()),)).fetchone()[0]
+        return {"entries": count, "bytes": self._bytes, "maxBytes": self.maxBytes, "missing": missing}
+
+    def log(self, msg):
+        if debug_mode:
+            qDebug(msg)
+
+
+class DiskCache:
+    """Manages tile stores. One store file is created for each service url in the cache directory."""
+
+    def __init__(self, directory, maxBytesPerStore):
+        self.directory = directory
+        self.maxBytesPerStore = maxBytesPerStore
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def store(self, serviceUrl):
+        """returns the tile store of the service. returns None if disk cache is disabled or unavailable."""
+        if self.maxBytesPerStore <= 0:
+            return None
+
+        with self._lock:
+            if serviceUrl in self._stores:
+                return self._stores[serviceUrl]
+
+            try:
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                filename = os.path.join(self.directory, hashlib.md5(serviceUrl.encode("utf-8")).hexdigest() + ".sqlite")
+                store = DiskTileStore(filename, serviceUrl, self.maxBytesPerStore)
+            except (OSError, sqlite3.Error) as e:
+                qDebug("Failed to open disk cache: %s" % str(e))
+                store = None    # do not try again
+            self._stores[serviceUrl] = store
+            return store
+
+    def setMaxBytesPerStore(self, maxBytes):
+        with self._lock:
+            self.maxBytesPerStore = maxBytes
+            for store in self._stores.values():
+                if store:
+                    store.setMaxBytes(maxBytes)
+
+    def close(self):
+        with self._lock:
+            for store in self._stores.values():
+                if store:
+                    store.close()
+            self._stores = {}
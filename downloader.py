@@ -18,92 +18,320 @@
  *                                                                         *
  ***************************************************************************/
 """
-from PyQt4.QtCore import QDateTime, QEventLoop, QObject, QTimer, QUrl, qDebug, pyqtSignal
+from PyQt4.QtCore import QByteArray, QDateTime, QEventLoop, QObject, QTimer, QUrl, qDebug, pyqtSignal
 from PyQt4.QtNetwork import QNetworkRequest, QNetworkReply
 from qgis.core import QgsNetworkAccessManager
+from collections import deque
+from email.utils import mktime_tz, parsedate_tz
+import heapq
+import random
 import threading
+import time
 
 debug_mode = 0
 
 
-class Downloader(QObject):
-    # error status
-    NO_ERROR = 0
-    TIMEOUT_ERROR = 4
-    UNKNOWN_ERROR = -1
-
-    # PyQt signals
-    replyFinished = pyqtSignal(str)
-    allRepliesFinished = pyqtSignal()
-
-    def __init__(self, parent=None, maxConnections=2, defaultCacheExpiration=24, userAgent=""):
+class RequestQueue:
+    """Priority queue of urls. A url with smaller priority value is popped first.
+    Pushing a queued url again changes its priority."""
+
+    def __init__(self):
+        self._heap = []
+        self._priorities = {}
+        self._count = 0
+
+    def push(self, url, priority):
+        self._priorities[url] = priority
+        heapq.heappush(self._heap, (priority, self._count, url))
+        self._count += 1
+
+    def pop(self):
+        while self._heap:
+            priority, _, url = heapq.heappop(self._heap)
+            if self._priorities.get(url) == priority:    # skip removed or re-prioritized entries
+                del self._priorities[url]
+                return url
+        return None
+
+    def peek(self):
+        while self._heap:
+            priority, _, url = self._heap[0]
+            if self._priorities.get(url) == priority:
+                return url
+            heapq.heappop(self._heap)
+        return None
+
+    def remove(self, url):
+        self._priorities.pop(url, None)
+
+    def __contains__(self, url):
+        return url in self._priorities
+
+    def __len__(self):
+        return len(self._priorities)
+
+
+class DownloadResult:
+    """Result of a request. The same result is passed to all the downloaders which requested the url."""
+
+    def __init__(self, url, data=None, error=False, fromCache=False, expiration=0, httpStatusCode=None):
+        self.url = url
+        self.data = data                # QByteArray, or None if no data has been received
+        self.error = error
+        self.notFound = False           # whether the server says the file does not exist (data is empty)
+        self.notModified = False        # whether the data has not been modified since the conditional request
+        self.etag = None                # validators of the data
+        self.lastModified = None
+        self.fromCache = fromCache      # whether the data came from the network cache
+        self.expiration = expiration    # expiration time of the data in seconds since the epoch
+        self.httpStatusCode = httpStatusCode
+
+    def validity(self):
+        """returns (expiration, etag, lastModified) of the data"""
+        return (self.expiration, self.etag, self.lastModified)
+
+
+class DownloadPool(QObject):
+    """Sends the requests of all downloaders. It lives in the main thread.
+    The number of connections to each host is limited over all downloaders, and a url
+    which is requested by several downloaders at the same time is downloaded only once.
+
+    Requests which failed with a transient error are retried with jittered exponential backoff.
+    A request waiting for retry keeps its connection, so a struggling host receives fewer requests.
+    If requests to a host fail repeatedly without any response, the circuit of the host is opened
+    and requests to it fail immediately for a while."""
+
+    # retry
+    RETRY_BASE_DELAY = 0.5        # seconds
+    RETRY_MAX_DELAY = 30
+    RETRY_HTTP_STATUS = [429, 500, 502, 503, 504]
+    NOT_FOUND_HTTP_STATUS = [204, 404, 410]
+    RETRY_ERRORS = [QNetworkReply.RemoteHostClosedError, QNetworkReply.TimeoutError,
+                    QNetworkReply.TemporaryNetworkFailureError,
+                    QNetworkReply.OperationCanceledError]   # requests are canceled by QGIS on network timeout
+
+    # circuit breaker
+    CIRCUIT_BREAKER_THRESHOLD = 5   # number of consecutive failures to open the circuit
+    CIRCUIT_BREAKER_TIMEOUT = 30    # seconds until requests are tried again
+
+    # emitted when a connection to the host has been released
+    slotAvailable = pyqtSignal(str)
+
+    def __init__(self, parent=None, defaultCacheExpiration=24, userAgent="", maxRetries=3):
         QObject.__init__(self, parent)
 
-        self.maxConnections = maxConnections
         self.defaultCacheExpiration = defaultCacheExpiration  # hours
         self.userAgent = userAgent
-
-        # initialize variables
-        self.clear()
-        self.sync = False
-
-        self.eventLoop = QEventLoop()
-
-        self.timer = QTimer()
-        self.timer.setSingleShot(True)
-        self.timer.timeout.connect(self.timeOut)
-        self.redirected_URLs = {}
-
-    def clear(self):
-        self.queue = []
-        self.requestingReplies = {}
-        self.fetchedFiles = {}
-
+        self.maxRetries = maxRetries
+
+        self.replies = {}         # url: reply
+        self.subscribers = {}     # url: list of [callback, prefetch]
+        self.hosts = {}           # url: host
+        self.headers = {}         # url: raw headers of conditional request
+        self.connections = {}     # host: number of requests in progress (including ones waiting for retry)
+        self.attempts = {}        # url: number of failed attempts
+        self.retryTimers = {}     # url: timer to retry the request
+
+        self.hostFailures = {}    # host: number of consecutive failures
+        self.circuitOpenUntil = {}  # host: time until which requests to the host fail immediately
+        self.failedFast = []      # list of (url, callback) to be notified of failure
+        self.failFastTimer = QTimer()
+        self.failFastTimer.setSingleShot(True)
+        self.failFastTimer.timeout.connect(self._notifyFailedFast)
+        self.resetStats()
+
+    def resetStats(self):
+        self._requests = 0
+        self._coalesced = 0
+        self._preempted = 0
+        self._retries = 0
+        self._failedFast = 0
+        self._notFound = 0
+        self._notModified = 0
         self._successes = 0
         self._errors = 0
         self._cacheHits = 0
+        self._bytes = 0
+
+    def request(self, url, callback, maxConnections, prefetch=False, headers=None):
+        """request a file. callback(url, result) is called with a DownloadResult when the request has finished.
+        returns False if maxConnections connections to the host are in use. a request for prefetch
+        gives its connection to a normal request if the host has no free connection.
+        headers is a dict of raw headers for a conditional request (If-None-Match and If-Modified-Since)."""
+        subscribers = self.subscribers.get(url)
+        if subscribers is not None and self.headers.get(url) and not headers:
+            # a conditional request cannot provide data to an unconditional request. send it again
+            # without the conditions. callbacks of the conditional request accept full data as well
+            del self.headers[url]
+            reply = self.replies.pop(url, None)
+            if reply:
+                reply.finished.disconnect(self._replyFinished)
+                reply.abort()
+                QgsNetworkAccessManager.instance().deleteReply(reply)
+                self._send(url)
+
+        if subscribers is not None:
+            # join the request in progress
+            for subscriber in subscribers:
+                if subscriber[0] == callback:
+                    subscriber[1] = subscriber[1] and prefetch
+                    return True
+            subscribers.append([callback, prefetch])
+            self._coalesced += 1
+            return True
+
+        host = QUrl(url).host()
+        if self.isCircuitOpen(host):
+            # fail fast. callback is called after returning
+            self._failedFast += 1
+            self.failedFast.append((url, callback))
+            if not self.failFastTimer.isActive():
+                self.failFastTimer.start(0)
+            return True
+
+        preempted = None
+        if self.connections.get(host, 0) >= maxConnections:
+            if not prefetch:
+                preempted = self._preemptPrefetch(host)
+            if preempted is None:
+                return False
+
+        self.log("DownloadPool.request: %s" % url)
+        if headers:
+            self.headers[url] = headers
+        self._send(url)
+        self.subscribers[url] = [[callback, prefetch]]
+        self.hosts[url] = host
+        self.connections[host] = self.connections.get(host, 0) + 1
+        self._requests += 1
+
+        if preempted:
+            self._notify(*preempted)
+        return True
+
+    def _send(self, url):
+        reply = QgsNetworkAccessManager.instance().get(self.createRequest(url, self.headers.get(url)))
+        reply.finished.connect(self._replyFinished)
+        self.replies[url] = reply
 
-        self.errorStatus = Downloader.NO_ERROR
+    def cancel(self, url, callback):
+        """cancel the request of the callback. the request is aborted if no other callback is waiting for it"""
+        self.failedFast = [f for f in self.failedFast if f != (url, callback)]
+        subscribers = self.subscribers.get(url)
+        if subscribers is None:
+            return
+        subscribers[:] = [s for s in subscribers if s[0] != callback]
+        if not subscribers:
+            host = self.hosts[url]
+            self._abort(url)
+            self.slotAvailable.emit(host)
+
+    def abortAll(self):
+        for url in self.subscribers.keys():
+            self._notify(url, self._abort(url), DownloadResult(url, error=True))
+        self._notifyFailedFast()
+
+    def _preemptPrefetch(self, host):
+        # abort a request to the host which is needed only for prefetch
+        for url, subscribers in self.subscribers.items():
+            if self.hosts[url] == host and all(s[1] for s in subscribers):
+                self.log("DownloadPool: prefetch preempted: %s" % url)
+                self._preempted += 1
+                return url, self._abort(url), DownloadResult(url, error=True)
+        return None
+
+    def _abort(self, url):
+        # abort a request without waiting for its finished signal. returns the subscribers
+        reply = self.replies.pop(url, None)
+        if reply:
+            reply.finished.disconnect(self._replyFinished)
+            reply.abort()
+            QgsNetworkAccessManager.instance().deleteReply(reply)
+        self._release(url)
+        return self.subscribers.pop(url)
+
+    def _release(self, url):
+        self.attempts.pop(url, None)
+        self.headers.pop(url, None)
+        timer = self.retryTimers.pop(url, None)
+        if timer:
+            timer.stop()
+
+        host = self.hosts.pop(url)
+        self.connections[host] -= 1
+        if self.connections[host] <= 0:
+            del self.connections[host]
+
+    def _notify(self, url, subscribers, result):
+        for callback, prefetch in subscribers:
+            callback(url, result)
+
+    def _notifyFailedFast(self):
+        failedFast, self.failedFast = self.failedFast, []
+        for url, callback in failedFast:
+            callback(url, DownloadResult(url, error=True))
 
     def _replyFinished(self):
         reply = self.sender()
-        url = reply.request().url().toString()
-        status_code = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        url = None
+        for u, r in self.replies.items():
+            if r is reply:
+                url = u
+                break
+        if url is None:
+            QgsNetworkAccessManager.instance().deleteReply(reply)
+            return
 
-        if status_code in [301, 302]:
-            # print	 "Redirection"
+        httpStatusCode = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if httpStatusCode in [301, 302]:
+            # follow the redirection. the connection is kept for the original url
             redirect = reply.attribute(QNetworkRequest.RedirectionTargetAttribute)
-
-            # create request
-            request = QNetworkRequest(redirect)
-            if self.userAgent:
-                request.setRawHeader("User-Agent", self.userAgent)  # will be overwritten in QgsNetworkAccessManager::createRequest() since 2.2
-
             QgsNetworkAccessManager.instance().deleteReply(reply)
-            # send request
-            reply = QgsNetworkAccessManager.instance().get(request)
+            reply = QgsNetworkAccessManager.instance().get(self.createRequest(redirect, self.headers.get(url)))
             reply.finished.connect(self._replyFinished)
-
-            self.redirected_URLs[redirect.toString()] = url
-
-            self.replyFinished.emit(url)
+            self.replies[url] = reply
             return
 
-        if url in self.redirected_URLs:
-            url = self.redirected_URLs[url]
+        host = self.hosts[url]
+        error = reply.error()
+        if error != QNetworkReply.NoError and (httpStatusCode in self.RETRY_HTTP_STATUS or
+                                               (httpStatusCode is None and error in self.RETRY_ERRORS)):
+            if httpStatusCode is None:
+                self._hostFailed(host)    # no response from the server. throttling and server errors are only retried
+            delay = self.retryDelay(url, reply)
+            QgsNetworkAccessManager.instance().deleteReply(reply)
+            del self.replies[url]
+            if delay is not None:
+                self.log("DownloadPool: retry in %.1f s: %s (%s)" % (delay, url, str(httpStatusCode or error)))
+                self._retries += 1
+                timer = QTimer()
+                timer.setSingleShot(True)
+                timer.timeout.connect(lambda: self._retry(url))
+                timer.start(int(delay * 1000))
+                self.retryTimers[url] = timer
+                return
+
+            self._finish(url, DownloadResult(url, error=True, httpStatusCode=httpStatusCode))
+            return
 
-        if not url in self.fetchedFiles:
-            self.fetchedFiles[url] = None
+        result = DownloadResult(url, httpStatusCode=httpStatusCode)
+        if error == QNetworkReply.NoError:
+            self.hostFailures.pop(host, None)
+            self._successes += 1
 
-        if url in self.requestingReplies:
-            del self.requestingReplies[url]
+            if reply.hasRawHeader("ETag"):
+                result.etag = str(reply.rawHeader("ETag"))
+            if reply.hasRawHeader("Last-Modified"):
+                result.lastModified = str(reply.rawHeader("Last-Modified"))
 
-        httpStatusCode = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
-        if reply.error() == QNetworkReply.NoError:
-            self._successes += 1
+            if httpStatusCode == 304:
+                # response to a conditional request. only the expiration is updated
+                self._notModified += 1
+                result.notModified = True
 
-            if reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute):
+            elif reply.attribute(QNetworkRequest.SourceIsFromCacheAttribute):
                 self._cacheHits += 1
+                result.fromCache = True
 
             elif not reply.hasRawHeader("Cache-Control"):
                 cache = QgsNetworkAccessManager.instance().cache()
@@ -115,22 +343,294 @@ class Downloader(QObject):
                         cache.updateMetaData(metadata)
                         self.log("Default expiration date has been set: %s (%d h)" % (url, self.defaultCacheExpiration))
 
-            if reply.isReadable():
-                data = reply.readAll()
-                self.fetchedFiles[url] = data
+            result.expiration = self.cacheExpiration(reply)
+
+            if result.notModified:
+                pass
+            elif reply.isReadable():
+                result.data = reply.readAll()
+                self._bytes += result.data.size()
                 reply.setFinished(True)
             else:
                 qDebug("http status code: " + str(httpStatusCode))
 
         else:
+            if httpStatusCode is None:
+                self._hostFailed(host)    # no response from the server
+            self._errors += 1
+            result.error = True
+
+        if httpStatusCode in self.NOT_FOUND_HTTP_STATUS:
+            self._notFound += 1
+            result.notFound = True
+            result.data = QByteArray()
+
+        del self.replies[url]
+        QgsNetworkAccessManager.instance().deleteReply(reply)
+        self._finish(url, result)
+
+    def _finish(self, url, result):
+        host = self.hosts[url]
+        self._release(url)
+        self._notify(url, self.subscribers.pop(url), result)
+        self.slotAvailable.emit(host)
+
+    def _retry(self, url):
+        self.retryTimers.pop(url, None)
+        if url not in self.subscribers:
+            return
+
+        if self.isCircuitOpen(self.hosts[url]):
+            self._errors += 1
+            self._finish(url, DownloadResult(url, error=True))
+        else:
+            self._send(url)
+
+    def retryDelay(self, url, reply):
+        """returns seconds to wait before retrying the request, or None if it should not be retried"""
+        attempts = self.attempts.get(url, 0) + 1
+        self.attempts[url] = attempts
+        if attempts > self.maxRetries or self.isCircuitOpen(self.hosts[url]):
+            self._errors += 1
+            return None
+
+        retryAfter = self.retryAfter(reply)
+        if retryAfter is not None:
+            if retryAfter > self.RETRY_MAX_DELAY:
+                # the server is not going to be available soon
+                self.circuitOpenUntil[self.hosts[url]] = time.time() + retryAfter
+                self._errors += 1
+                return None
+            return retryAfter
+
+        # exponential backoff with jitter
+        delay = min(self.RETRY_BASE_DELAY * 2 ** (attempts - 1), self.RETRY_MAX_DELAY)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def retryAfter(self, reply):
+        # seconds specified by Retry-After header, or None
+        if not reply.hasRawHeader("Retry-After"):
+            return None
+        value = str(reply.rawHeader("Retry-After")).strip()
+        try:
+            return max(0, int(value))
+        except ValueError:
+            t = parsedate_tz(value)
+            return max(0, mktime_tz(t) - time.time()) if t else None
+
+    def _hostFailed(self, host):
+        failures = self.hostFailures.get(host, 0) + 1
+        self.hostFailures[host] = failures
+        if failures >= self.CIRCUIT_BREAKER_THRESHOLD:
+            # a failure after the circuit has been closed again opens it immediately (half-open state)
+            self.log("DownloadPool: circuit opened: %s" % host)
+            self.circuitOpenUntil[host] = max(self.circuitOpenUntil.get(host, 0), time.time() + self.CIRCUIT_BREAKER_TIMEOUT)
+
+    def isCircuitOpen(self, host):
+        return self.circuitOpenUntil.get(host, 0) > time.time()
+
+    def cacheExpiration(self, reply):
+        """returns expiration time of the reply content in seconds since the epoch,
+        following Cache-Control and Expires headers. default expiration is used if they are absent."""
+        now = int(time.time())
+        if reply.hasRawHeader("Cache-Control"):
+            directives = [d.strip().lower() for d in str(reply.rawHeader("Cache-Control")).split(",")]
+            if "no-store" in directives or "no-cache" in directives:
+                return now
+            for d in directives:
+                if d.startswith("max-age="):
+                    try:
+                        return now + int(d[8:])
+                    except ValueError:
+                        break
+
+        if reply.hasRawHeader("Expires"):
+            t = parsedate_tz(str(reply.rawHeader("Expires")))
+            return mktime_tz(t) if t else now
+
+        return now + self.defaultCacheExpiration * 3600
+
+    def createRequest(self, url, headers=None):
+        request = QNetworkRequest(QUrl(url))
+        if self.userAgent:
+            request.setRawHeader("User-Agent",
+                                 self.userAgent)  # will be overwritten in QgsNetworkAccessManager::createRequest() since 2.2
+        if headers:
+            # the response to a conditional request should not be replaced with the content of the network cache
+            request.setAttribute(QNetworkRequest.CacheLoadControlAttribute, QNetworkRequest.AlwaysNetwork)
+            for name, value in headers.items():
+                request.setRawHeader(name, value)
+        return request
+
+    def log(self, msg):
+        if debug_mode:
+            qDebug(msg)
+
+    def stats(self):
+        return {"requests": self._requests,
+                "running": len(self.replies),
+                "coalesced": self._coalesced,
+                "preempted": self._preempted,
+                "retries": self._retries,
+                "failedFast": self._failedFast,
+                "openCircuits": [host for host in self.circuitOpenUntil if self.isCircuitOpen(host)],
+                "successed": self._successes,
+                "errors": self._errors,
+                "notFound": self._notFound,
+                "notModified": self._notModified,
+                "cacheHits": self._cacheHits,
+                "bytes": self._bytes,
+                "connections": dict(self.connections)}
+
+
+class FetchBatch(QObject):
+    """Handle of a fetch request, which can be created in any thread. Downloader emits the signals
+    and calls the callbacks in the main thread. A render thread can wait for finished signal
+    without polling, and can cancel the fetch with cancel()."""
+
+    tileFinished = pyqtSignal(str)
+    finished = pyqtSignal()
+    cancelRequested = pyqtSignal()
+
+    def __init__(self, urls, priorities=None, timeoutSec=0):
+        QObject.__init__(self)
+        self.urls = urls
+        self.priorities = priorities    # a dict {url: priority}. smaller value is fetched first
+        self.timeoutSec = timeoutSec
+        self.files = {}                 # url: data, or None if failed
+        self.validities = {}            # url: (expiration, etag, lastModified) of fetched data
+        self.cancelled = False
+        self._callbacks = []
+        self._done = threading.Event()
+
+    def addCallback(self, callback):
+        """callback(url, data, validity) is called in the main thread each time a file has been fetched.
+        validity is (expiration, etag, lastModified) of the data, or None if the request has failed"""
+        self._callbacks.append(callback)
+
+    def cancel(self):
+        """cancellation token. thread-safe"""
+        if not (self.cancelled or self.isFinished()):
+            self.cancelled = True
+            self.cancelRequested.emit()
+
+    def isFinished(self):
+        return self._done.is_set()
+
+    def _setFile(self, url, data, validity=None):
+        self.files[url] = data
+        if validity is not None:
+            self.validities[url] = validity
+        for callback in self._callbacks:
+            callback(url, data, validity)
+        self.tileFinished.emit(url)
+
+    def _finish(self):
+        if not self._done.is_set():
+            self._done.set()
+            self.finished.emit()
+
+
+class Downloader(QObject):
+    """Fetches files for a layer. Requests are sent through a DownloadPool, which is usually shared by
+    all downloaders of the plugin. A private pool is created if no pool is given."""
+
+    # error status
+    NO_ERROR = 0
+    TIMEOUT_ERROR = 4
+    UNKNOWN_ERROR = -1
+
+    # requests of a cancelled batch are kept for this time, so that the next fetch can adopt them
+    CANCEL_GRACE_PERIOD = 300     # ms
+
+    # PyQt signals
+    replyFinished = pyqtSignal(str)
+    allRepliesFinished = pyqtSignal()
+    prefetchFinished = pyqtSignal(str)
+    revalidateFinished = pyqtSignal(str)
+
+    def __init__(self, parent=None, maxConnections=2, defaultCacheExpiration=24, userAgent="", pool=None):
+        QObject.__init__(self, parent)
+
+        self.maxConnections = maxConnections
+        if pool is None:
+            pool = DownloadPool(self, defaultCacheExpiration, userAgent)
+        self.pool = pool
+        self.pool.slotAvailable.connect(self._slotAvailable)
+
+        # initialize variables
+        self.clear()
+        self.sync = False
+
+        self.eventLoop = QEventLoop()
+
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.timeOut)
+
+        self.cancelTimer = QTimer()
+        self.cancelTimer.setSingleShot(True)
+        self.cancelTimer.setInterval(self.CANCEL_GRACE_PERIOD)
+        self.cancelTimer.timeout.connect(self.abort)
+
+        # prefetch. prefetch requests use connection slots which are not used by fetch requests
+        self.prefetchQueue = RequestQueue()
+        self.prefetching = set()        # urls of prefetch requests in progress
+        self.prefetchedFiles = {}       # url: DownloadResult
+        self.prefetchBudget = 0         # max number of prefetch requests per minute
+        self._prefetchTimes = deque()   # times when prefetch requests were sent in the last minute
+        self.prefetchTimer = QTimer()
+        self.prefetchTimer.setSingleShot(True)
+        self.prefetchTimer.timeout.connect(self.fetchNextPrefetch)
+
+        # revalidation of expired files in background. it takes priority over prefetch
+        self.revalidateQueue = RequestQueue()
+        self.revalidating = set()       # urls of revalidation requests in progress
+        self.revalidateHeaders = {}     # url: raw headers of conditional request
+        self.revalidatedFiles = {}      # url: DownloadResult
+        self._revalidateCount = 0
+
+    def clear(self):
+        self.batch = None
+        self.queue = RequestQueue()
+        self.requesting = set()   # urls of requests in progress
+        self.fetchedFiles = {}
+        self.validities = {}      # url: (expiration, etag, lastModified) of fetched files
+
+        self._successes = 0
+        self._errors = 0
+        self._notFound = 0
+        self._cacheHits = 0
+
+        self.errorStatus = Downloader.NO_ERROR
+
+    def _requestFinished(self, url, result):
+        if url not in self.requesting:
+            return      # requested by a previous fetch
+
+        self.requesting.remove(url)
+        self.fetchedFiles[url] = result.data
+        validity = None if result.error else result.validity()
+        if validity is not None:
+            self.validities[url] = validity
+        if self.batch:
+            self.batch._setFile(url, result.data, validity)
+
+        if result.notFound:
+            # not an error. the tile does not exist
+            self._notFound += 1
+        elif result.error:
             self._errors += 1
             if self.errorStatus == self.NO_ERROR:
                 self.errorStatus = self.UNKNOWN_ERROR
+        else:
+            self._successes += 1
+            if result.fromCache:
+                self._cacheHits += 1
 
         self.replyFinished.emit(url)
-        QgsNetworkAccessManager.instance().deleteReply(reply)
 
-        if len(self.queue) + len(self.requestingReplies) == 0:
+        if len(self.queue) + len(self.requesting) == 0:
             # all replies have been received
             if self.sync:
                 self.logT("eventLoop.quit()")
@@ -138,12 +638,25 @@ class Downloader(QObject):
             else:
                 self.timer.stop()
 
+            if self.batch:
+                self.batch._finish()
             self.allRepliesFinished.emit()
 
         elif len(self.queue) > 0:
             # start fetching the next file
             self.fetchNext()
 
+        if len(self.queue) == 0:
+            # connection slot is not needed by fetch requests
+            self.fetchNextRevalidate()
+            self.fetchNextPrefetch()
+
+    def _slotAvailable(self, host):
+        # a connection has been released by a request of any downloader
+        self.fetchNext()
+        self.fetchNextRevalidate()
+        self.fetchNextPrefetch()
+
     def timeOut(self):
         self.log("Downloader.timeOut()")
         self.abort()
@@ -151,54 +664,208 @@ class Downloader(QObject):
 
     def abort(self):
         # clear queue and abort sent requests
-        self.queue = []
+        self.queue = RequestQueue()
         self.timer.stop()
+        self.cancelTimer.stop()
 
-        for reply in self.requestingReplies.itervalues():
-            reply.abort()
+        for url in list(self.requesting):
+            self.pool.cancel(url, self._requestFinished)
+            self._requestFinished(url, DownloadResult(url, error=True))
         #self.errorStatus = Downloader.UNKNOWN_ERROR
 
+        if self.batch:
+            self.batch._finish()
+
+    def cancelBatch(self, batch):
+        """finish the batch if it is the current one. queued urls are dropped, and requests in progress
+        are aborted unless the next fetch adopts them within the grace period. as a stopped render job is
+        followed by the next one immediately, requests are not aborted at once. nothing is done if another
+        fetch has been started, which has adopted the requests it needs"""
+        if batch is self.batch and not batch.isFinished():
+            self.log("cancelBatch: %d files" % len(batch.urls))
+            self.queue = RequestQueue()
+            self.timer.stop()
+            batch._finish()
+            if self.requesting:
+                self.cancelTimer.start()
+
+    def _cancelRequested(self):
+        self.cancelBatch(self.sender())
+
+    def release(self):
+        """cancel all requests of this downloader. called when the layer is removed"""
+        self.cancelPrefetch()
+        self.revalidateQueue = RequestQueue()
+        self.revalidateHeaders = {}
+        revalidating, self.revalidating = self.revalidating, set()
+        for url in revalidating:
+            self.pool.cancel(url, self._revalidateRequestFinished)
+        self.queue = RequestQueue()
+        self.timer.stop()
+        self.cancelTimer.stop()
+
+        requesting, self.requesting = self.requesting, set()
+        for url in requesting:
+            self.pool.cancel(url, self._requestFinished)
+
+        if self.batch:
+            self.batch._finish()
+
     def fetchNext(self):
-        if len(self.queue) == 0:
+        # send requests while connection slots are available
+        while len(self.queue) > 0 and len(self.requesting) < self.maxConnections:
+            url = self.queue.peek()
+            if not self.pool.request(url, self._requestFinished, self.maxConnections):
+                break
+            self.log("fetchNext: %s" % url)
+            self.queue.remove(url)
+            self.requesting.add(url)
+
+    def prefetchFiles(self, urlList, budget, priorities=None):
+        """queue files to fetch in idle time. at most budget files are requested per minute.
+        the result (DownloadResult) is stored in prefetchedFiles and prefetchFinished signal is emitted.
+        priorities is a dict {url: priority}. files are fetched in the order of urlList if it is not given."""
+        self.prefetchBudget = budget
+        self.prefetchQueue = RequestQueue()
+        for i, url in enumerate(urlList):
+            if url not in self.prefetching and not self.isPending(url):
+                self.prefetchQueue.push(url, priorities.get(url, i) if priorities else i)
+
+        self.fetchNextPrefetch()
+
+    def cancelPrefetch(self):
+        self.prefetchQueue = RequestQueue()
+        self.prefetchTimer.stop()
+
+        prefetching, self.prefetching = self.prefetching, set()
+        for url in prefetching:
+            self.pool.cancel(url, self._prefetchRequestFinished)
+
+    def fetchNextPrefetch(self):
+        while len(self.prefetchQueue) > 0 and len(self.queue) + len(self.revalidateQueue) == 0:
+            if len(self.requesting) + len(self.revalidating) + len(self.prefetching) >= self.maxConnections:
+                return
+
+            # prefetch budget
+            now = time.time()
+            while self._prefetchTimes and self._prefetchTimes[0] < now - 60:
+                self._prefetchTimes.popleft()
+            if len(self._prefetchTimes) >= self.prefetchBudget:
+                if self._prefetchTimes and not self.prefetchTimer.isActive():
+                    self.prefetchTimer.start(int((self._prefetchTimes[0] + 60 - now) * 1000) + 1)
+                return
+
+            url = self.prefetchQueue.peek()
+            if not self.pool.request(url, self._prefetchRequestFinished, self.maxConnections, prefetch=True):
+                return
+            self.log("fetchNextPrefetch: %s" % url)
+            self.prefetchQueue.remove(url)
+            self.prefetching.add(url)
+            self._prefetchTimes.append(now)
+
+    def _prefetchRequestFinished(self, url, result):
+        if url not in self.prefetching:
             return
-        url = self.queue.pop(0)
-        self.log("fetchNext: %s" % url)
+        self.prefetching.remove(url)
+
+        if (not result.error or result.notFound) and result.data is not None:
+            self.prefetchedFiles[url] = result
+            self.prefetchFinished.emit(url)
+
+        self.fetchNextPrefetch()
+
+    def revalidateFiles(self, files):
+        """request files in idle time to refresh expired data. files is a list of (url, etag, lastModified).
+        the request is conditional if etag or lastModified is given. the result (DownloadResult) is stored
+        in revalidatedFiles and revalidateFinished signal is emitted."""
+        for url, etag, lastModified in files:
+            if url in self.revalidating or url in self.revalidateQueue:
+                continue
+            headers = {}
+            if etag:
+                headers["If-None-Match"] = str(etag)
+            if lastModified:
+                headers["If-Modified-Since"] = str(lastModified)
+            self.revalidateHeaders[url] = headers
+            self.revalidateQueue.push(url, self._revalidateCount)
+            self._revalidateCount += 1
+
+        self.fetchNextRevalidate()
+
+    def fetchNextRevalidate(self):
+        while len(self.revalidateQueue) > 0 and len(self.queue) == 0:
+            if len(self.requesting) + len(self.revalidating) + len(self.prefetching) >= self.maxConnections:
+                return
+
+            url = self.revalidateQueue.peek()
+            if not self.pool.request(url, self._revalidateRequestFinished, self.maxConnections, prefetch=True,
+                                     headers=self.revalidateHeaders.get(url)):
+                return
+            self.log("fetchNextRevalidate: %s" % url)
+            self.revalidateQueue.remove(url)
+            self.revalidating.add(url)
+
+    def _revalidateRequestFinished(self, url, result):
+        if url not in self.revalidating:
+            return
+        self.revalidating.remove(url)
+        self.revalidateHeaders.pop(url, None)
 
-        # create request
-        request = QNetworkRequest(QUrl(url))
-        if self.userAgent:
-            request.setRawHeader("User-Agent",
-                                 self.userAgent)  # will be overwritten in QgsNetworkAccessManager::createRequest() since 2.2
+        if not result.error or result.notFound:
+            self.revalidatedFiles[url] = result
+            self.revalidateFinished.emit(url)
 
-        # send request
-        reply = QgsNetworkAccessManager.instance().get(request)
-        reply.finished.connect(self._replyFinished)
-        self.requestingReplies[url] = reply
-        return reply
+        self.fetchNextRevalidate()
+        self.fetchNextPrefetch()
 
-    def fetchFiles(self, urlList, timeoutSec=0):
+    def fetchFiles(self, urlList, timeoutSec=0, priorities=None):
         self.log("fetchFiles()")
-        files = self._fetch(True, urlList, timeoutSec)
+        files = self._fetch(True, urlList, timeoutSec, priorities)
         self.log("fetchFiles() End: %d" % self.errorStatus)
         return files
 
-    def fetchFilesAsync(self, urlList, timeoutSec=0):
-        self.log("fetchFilesAsync()")
-        self._fetch(False, urlList, timeoutSec)
+    def fetchBatch(self, batch):
+        """start fetching the files of the batch (FetchBatch). the previous batch finishes here"""
+        self._fetch(False, batch.urls, batch.timeoutSec, batch.priorities, batch)
 
-    def _fetch(self, sync, urlList, timeoutSec):
+    def _fetch(self, sync, urlList, timeoutSec, priorities=None, batch=None):
+        # priorities: a dict {url: priority}. smaller value is fetched first.
+        # if it is not given, files are fetched in the order of urlList.
+        # fetch requests take priority over prefetch requests
+        self.cancelPrefetch()
+        self.cancelTimer.stop()
+
+        if self.batch:
+            self.batch._finish()
+
+        previous = self.requesting
         self.clear()
         self.sync = sync
 
+        if batch:
+            # connect before checking the flag, so that cancellation is not missed
+            batch.cancelRequested.connect(self._cancelRequested)
+            if batch.cancelled:
+                urlList = []
+            self.batch = batch
+
+        # requests of the previous fetch which are still in progress are adopted if the urls are
+        # in urlList, and are cancelled otherwise. urls queued for the previous fetch are dropped
+        wanted = set(urlList)
+        self.requesting = previous & wanted
+        for i, url in enumerate(urlList):
+            if url not in self.requesting:
+                self.queue.push(url, priorities.get(url, i) if priorities else i)
+
+        for url in previous - wanted:
+            self.pool.cancel(url, self._requestFinished)
+
         if not urlList:
+            if batch:
+                batch._finish()
             return {}
 
-        for url in urlList:
-            if url not in self.queue:
-                self.queue.append(url)
-
-        for i in range(self.maxConnections):
-            self.fetchNext()
+        self.fetchNext()
 
         if timeoutSec > 0:
             self.timer.setInterval(timeoutSec * 1000)
@@ -221,11 +888,14 @@ class Downloader(QObject):
         if debug_mode:
             qDebug("%s: %s" % (str(threading.current_thread()), msg))
 
+    def isPending(self, url):
+        return url in self.requesting or url in self.queue
+
     def finishedCount(self):
         return len(self.fetchedFiles)
 
     def unfinishedCount(self):
-        return len(self.queue) + len(self.requestingReplies)
+        return len(self.queue) + len(self.requesting)
 
     def stats(self):
         finished = self.finishedCount()
@@ -235,5 +905,6 @@ class Downloader(QObject):
                 "unfinished": unfinished,
                 "successed": self._successes,
                 "errors": self._errors,
+                "notFound": self._notFound,
                 "cacheHits": self._cacheHits,
                 "downloaded": self._successes - self._cacheHits}
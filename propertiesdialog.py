@@ -22,6 +22,7 @@
 from PyQt4.QtCore import pyqtSignal
 from PyQt4.QtGui import QDialog, QDialogButtonBox, QPainter
 
+from tiles import TileLayerDefinition
 from ui_propertiesdialog import Ui_Dialog
 
 class PropertiesDialog(QDialog):
@@ -47,8 +48,11 @@ class PropertiesDialog(QDialog):
     if i != -1:
       self.ui.comboBox_BlendingMode.setCurrentIndex(i)
 
+    self.ui.comboBox_Oversampling.setCurrentIndex(TileLayerDefinition.OVERSAMPLING_VALUES.index(layer.oversampling))
+
     if layer.layerDef.serviceUrl[0] == ":":
       self.ui.checkBox_SmoothRender.setEnabled(False)
+      self.ui.comboBox_Oversampling.setEnabled(False)
       self.ui.checkBox_CreditVisibility.setEnabled(False)
     else:
       self.ui.checkBox_SmoothRender.setChecked(layer.smoothRender)
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ WarpEngine
+   reprojects tile images with GDAL warper
+                              -------------------
+        begin                : 2012-12-16
+        copyright            : (C) 2013 by Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import threading
+from PyQt4.QtCore import Qt
+from PyQt4.QtGui import QImage
+from qgis.core import QgsCsException
+
+from tiles import crsKey, transformCache
+
+try:
+    from osgeo import gdal
+
+    hasGdal = True
+except:
+    hasGdal = False
+
+try:
+    import numpy
+
+    hasNumpy = True
+except ImportError:
+    hasNumpy = False
+
+
+def createWarpEngine(resampling="bilinear", errorThreshold=0.125, threads=0, memoryLimit=64):
+    """returns a WarpEngine, or a NumpyWarpEngine if python-gdal is not available. returns None if neither is available"""
+    if hasGdal:
+        return WarpEngine(resampling, errorThreshold, threads, memoryLimit)
+    if hasNumpy:
+        return NumpyWarpEngine(resampling, errorThreshold, threads, memoryLimit)
+    return None
+
+
+class WarpEngine:
+    """Reprojects images with GDAL warper. WKT of CRSs are reused across draws.
+    Images are premultiplied ARGB32, which are warped as 4-band byte rasters so that
+    resampling methods other than nearest neighbour interpolate each channel.
+    The warper reads and writes pixels of the images directly through MEM datasets opened on their
+    buffers. If it is not available, pixels are copied through MEM datasets reused across draws."""
+
+    RESAMPLING_METHODS = ["near", "bilinear", "cubic", "lanczos"]
+    MAX_IDLE_DATASETS = 4
+
+    def __init__(self, resampling="bilinear", errorThreshold=0.125, threads=0, memoryLimit=64):
+        self.setOptions(resampling, errorThreshold, threads, memoryLimit)
+        self._wkts = {}         # srsid: wkt
+        self._datasets = []     # idle datasets
+        self._lock = threading.Lock()
+        self.sharedBuffers = True   # whether MEM datasets can be opened on image buffers
+
+    def setOptions(self, resampling="bilinear", errorThreshold=0.125, threads=0, memoryLimit=64):
+        """resampling: one of RESAMPLING_METHODS.
+        errorThreshold: max error in pixels of the approximate transformer. 0 to transform each pixel exactly.
+        threads: number of warping threads. 0 to use all CPUs.
+        memoryLimit: working memory of the warper in MB."""
+        if resampling not in self.RESAMPLING_METHODS:
+            resampling = "bilinear"
+        self.resampling = resampling
+        self.errorThreshold = errorThreshold
+        self.threads = threads
+        self.memoryLimit = memoryLimit
+
+    def wkt(self, crs):
+        key = crsKey(crs)
+        wkt = self._wkts.get(key)
+        if wkt is None:
+            wkt = self._wkts[key] = str(crs.toWkt())
+        return wkt
+
+    def reproject(self, image, geotransform, sourceCrs, width, height, destGeotransform, destCrs, resampling=None):
+        """returns the reprojected image (width x height). resampling overrides the resampling method of the engine"""
+        srcWkt, dstWkt = self.wkt(sourceCrs), self.wkt(destCrs)
+        resampling = resampling or self.resampling
+
+        if self.sharedBuffers:
+            target = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+            target.fill(Qt.transparent)
+            src_ds = self._imageDataset(image, int(image.constBits()))
+            dst_ds = self._imageDataset(target, int(target.bits())) if src_ds else None
+            if dst_ds:
+                src_ds.SetProjection(srcWkt)
+                src_ds.SetGeoTransform(geotransform)
+                dst_ds.SetProjection(dstWkt)
+                dst_ds.SetGeoTransform(destGeotransform)
+                self._warp(src_ds, dst_ds, srcWkt, dstWkt, resampling)
+                dst_ds.FlushCache()
+                return target
+            self.sharedBuffers = False
+
+        data = self._reprojectCopy(image, geotransform, srcWkt, width, height, destGeotransform, dstWkt, resampling)
+        return QImage(data, width, height, QImage.Format_ARGB32_Premultiplied).copy()
+
+    def _imageDataset(self, image, address):
+        # MEM dataset which shares the pixel buffer of the image. the image must be alive while it is used
+        name = "MEM:::DATAPOINTER={0},PIXELS={1},LINES={2},BANDS=4,DATATYPE=Byte,PIXELOFFSET=4,LINEOFFSET={3}," \
+               "BANDOFFSET=1".format(address, image.width(), image.height(), image.bytesPerLine())
+        try:
+            return gdal.Open(name, gdal.GA_Update)
+        except RuntimeError:    # gdal exceptions are enabled
+            return None
+
+    def _reprojectCopy(self, image, geotransform, srcWkt, width, height, destGeotransform, dstWkt, resampling):
+        src_ds = self._dataset(image.width(), image.height())
+        dst_ds = self._dataset(width, height)
+        try:
+            src_ds.SetProjection(srcWkt)
+            src_ds.SetGeoTransform(geotransform)
+            self._writeImage(src_ds, image.bits().asstring(image.numBytes()), image.width(), image.height())
+
+            dst_ds.SetProjection(dstWkt)
+            dst_ds.SetGeoTransform(destGeotransform)
+            for i in range(4):
+                dst_ds.GetRasterBand(i + 1).Fill(0)
+
+            self._warp(src_ds, dst_ds, srcWkt, dstWkt, resampling)
+            return dst_ds.ReadRaster(0, 0, width, height, buf_type=gdal.GDT_Byte, band_list=[1, 2, 3, 4],
+                                     buf_pixel_space=4, buf_line_space=4 * width, buf_band_space=1)
+        finally:
+            self._release(src_ds)
+            self._release(dst_ds)
+
+    def _warp(self, src_ds, dst_ds, srcWkt, dstWkt, resampling):
+        resampling = getattr(gdal, {"near": "GRA_NearestNeighbour", "bilinear": "GRA_Bilinear",
+                                    "cubic": "GRA_Cubic", "lanczos": "GRA_Lanczos"}[resampling])
+        options = ["NUM_THREADS={0}".format(self.threads or "ALL_CPUS")]
+        memoryLimit = self.memoryLimit * 1024 * 1024
+        try:
+            gdal.ReprojectImage(src_ds, dst_ds, srcWkt, dstWkt, resampling, memoryLimit, self.errorThreshold,
+                                None, None, options)
+        except TypeError:
+            # GDAL 1.x has no warp options
+            gdal.ReprojectImage(src_ds, dst_ds, srcWkt, dstWkt, resampling, memoryLimit, self.errorThreshold)
+
+    def _writeImage(self, ds, data, width, height):
+        # ARGB32 pixels are BGRA bytes in little-endian order. the band order does not matter
+        # because all bands are resampled in the same way
+        ds.WriteRaster(0, 0, width, height, data, buf_type=gdal.GDT_Byte, band_list=[1, 2, 3, 4],
+                       buf_pixel_space=4, buf_line_space=4 * width, buf_band_space=1)
+
+    def _dataset(self, width, height):
+        with self._lock:
+            for ds in self._datasets:
+                if ds.RasterXSize == width and ds.RasterYSize == height:
+                    self._datasets.remove(ds)
+                    return ds
+        return gdal.GetDriverByName("MEM").Create("", width, height, 4, gdal.GDT_Byte)
+
+    def _release(self, ds):
+        with self._lock:
+            self._datasets.insert(0, ds)
+            del self._datasets[self.MAX_IDLE_DATASETS:]
+
+    def clear(self):
+        with self._lock:
+            self._datasets = []
+            self._wkts = {}
+
+
+class NumpyWarpEngine:
+    """Reprojects images with NumPy, which is used if python-gdal is not available. Source coordinates
+    are transformed exactly on a coarse mesh and interpolated for each pixel. If the CRSs are the same
+    (the map is rotated), source coordinates of each pixel are calculated with the affine transformation.
+    Pixels are read from and written to the image buffers directly."""
+
+    RESAMPLING_METHODS = ["near", "bilinear"]
+    MESH_SIZE = 16          # pixels, minimum interval of mesh points
+    MESH_CELLS = 64         # maximum number of mesh cells along each axis
+    STRIP_HEIGHT = 256      # rows which are processed at a time
+
+    def __init__(self, resampling="bilinear", errorThreshold=0.125, threads=0, memoryLimit=64):
+        self.setOptions(resampling, errorThreshold, threads, memoryLimit)
+
+    def setOptions(self, resampling="bilinear", errorThreshold=0.125, threads=0, memoryLimit=64):
+        """only resampling is used. other resampling methods than nearest neighbour are replaced with bilinear"""
+        self.resampling = "near" if resampling == "near" else "bilinear"
+
+    def reproject(self, image, geotransform, sourceCrs, width, height, destGeotransform, destCrs, resampling=None):
+        """returns the reprojected image (width x height). resampling overrides the resampling method of the engine"""
+        sample = _sampleNearest if (resampling or self.resampling) == "near" else _sampleBilinear
+        target = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+        target.fill(Qt.transparent)
+        src = _imageArray(image)
+        dst = _imageArray(target, writable=True)
+
+        g, s = destGeotransform, geotransform
+        mesh = None
+        if sourceCrs != destCrs:
+            # the number of coordinate transformations is bounded for large images
+            step = max(self.MESH_SIZE, -(-max(width, height) // self.MESH_CELLS))
+            mesh = self._mesh(width, height, step, g, s, destCrs, sourceCrs)
+
+        x = numpy.arange(width) + 0.5       # pixel centers
+        for top in range(0, height, self.STRIP_HEIGHT):
+            y = numpy.arange(top, min(top + self.STRIP_HEIGHT, height)) + 0.5
+            if mesh is None:
+                # destination pixel -> map coordinates -> source pixel
+                sx = (g[0] + g[1] * x[numpy.newaxis, :] + g[2] * y[:, numpy.newaxis] - s[0]) / s[1]
+                sy = (g[3] + g[4] * x[numpy.newaxis, :] + g[5] * y[:, numpy.newaxis] - s[3]) / s[5]
+            else:
+                sx = _interpolateMesh(mesh[0], step, x, y)
+                sy = _interpolateMesh(mesh[1], step, x, y)
+            dst[top:top + len(y), :width] = sample(src, sx, sy)
+        return target
+
+    def _mesh(self, width, height, step, g, s, destCrs, sourceCrs):
+        """returns source pixel coordinates (x and y arrays) of mesh points at every step pixels,
+        which are NaN where transformation failed"""
+        transform = transformCache.transform(destCrs, sourceCrs)
+        cols, rows = -(-width // step) + 1, -(-height // step) + 1
+        sx = numpy.empty((rows, cols))
+        sy = numpy.empty((rows, cols))
+        for j in range(rows):
+            py = j * step
+            for i in range(cols):
+                px = i * step
+                try:
+                    pt = transform.transform(g[0] + px * g[1] + py * g[2], g[3] + px * g[4] + py * g[5])
+                    sx[j, i] = (pt.x() - s[0]) / s[1]
+                    sy[j, i] = (pt.y() - s[3]) / s[5]
+                except QgsCsException:
+                    sx[j, i] = sy[j, i] = numpy.nan
+        return sx, sy
+
+    def clear(self):
+        """nothing to release. coordinate transforms are kept in the transform cache of the plugin"""
+        pass
+
+
+def _imageArray(image, writable=False):
+    # 2d array of ARGB32 pixels which shares the buffer of the image
+    ptr = image.bits() if writable else image.constBits()
+    ptr.setsize(image.byteCount())
+    return numpy.frombuffer(ptr, numpy.uint32).reshape(image.height(), image.bytesPerLine() // 4)
+
+
+def _interpolateMesh(mesh, step, x, y):
+    # values at pixel positions (x columns, y rows) interpolated bilinearly from mesh points at every step pixels
+    fx, fy = x / step, y / step
+    i = numpy.minimum(fx.astype(numpy.int32), mesh.shape[1] - 2)
+    j = numpy.minimum(fy.astype(numpy.int32), mesh.shape[0] - 2)
+    tx = (fx - i)[numpy.newaxis, :]
+    ty = (fy - j)[:, numpy.newaxis]
+    j = j[:, numpy.newaxis]
+    top = mesh[j, i] * (1 - tx) + mesh[j, i + 1] * tx
+    bottom = mesh[j + 1, i] * (1 - tx) + mesh[j + 1, i + 1] * tx
+    return top * (1 - ty) + bottom * ty
+
+
+def _sourceIndices(src, sx, sy):
+    # NaN and coordinates far outside the source are moved just outside it
+    h, w = src.shape
+    sx = numpy.where(numpy.isnan(sx), -2, numpy.clip(sx, -2, w + 2))
+    sy = numpy.where(numpy.isnan(sy), -2, numpy.clip(sy, -2, h + 2))
+    return sx, sy
+
+
+def _sampleNearest(src, sx, sy):
+    h, w = src.shape
+    sx, sy = _sourceIndices(src, sx, sy)
+    ix = numpy.floor(sx).astype(numpy.int32)
+    iy = numpy.floor(sy).astype(numpy.int32)
+    valid = (ix >= 0) & (ix < w) & (iy >= 0) & (iy < h)
+    out = numpy.zeros(sx.shape, numpy.uint32)
+    out[valid] = src[iy[valid], ix[valid]]
+    return out
+
+
+def _sampleBilinear(src, sx, sy):
+    # premultiplied channels are interpolated independently. pixels outside the source are transparent
+    h, w = src.shape
+    channels = src.view(numpy.uint8).reshape(h, w, 4)
+    sx, sy = _sourceIndices(src, sx - 0.5, sy - 0.5)
+    x0 = numpy.floor(sx)
+    y0 = numpy.floor(sy)
+    tx = (sx - x0)[..., numpy.newaxis]
+    ty = (sy - y0)[..., numpy.newaxis]
+    x0 = x0.astype(numpy.int32)
+    y0 = y0.astype(numpy.int32)
+
+    out = numpy.zeros(sx.shape + (4,), numpy.float32)
+    for dy, wy in [(0, 1 - ty), (1, ty)]:
+        for dx, wx in [(0, 1 - tx), (1, tx)]:
+            x, y = x0 + dx, y0 + dy
+            valid = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+            out[valid] += (wx * wy)[valid] * channels[y[valid], x[valid]]
+    return (out + 0.5).astype(numpy.uint8).view(numpy.uint32).reshape(sx.shape)
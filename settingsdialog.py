@@ -19,7 +19,7 @@
  *                                                                         *
  ***************************************************************************/
 """
-from PyQt4.QtCore import Qt, QSettings
+from PyQt4.QtCore import Qt, QSettings, QThread
 from PyQt4.QtGui import QDialog, QFileDialog
 
 from ui_settingsdialog import Ui_Dialog
@@ -36,8 +36,21 @@ class SettingsDialog(QDialog):
     settings = QSettings()
     self.ui.lineEdit_externalDirectory.setText(settings.value("/TileLayerPlugin/extDir", "", type=unicode))
     self.ui.spinBox_downloadTimeout.setValue(int(settings.value("/TileLayerPlugin/timeout", 30, type=int)))
+    self.ui.spinBox_memoryCacheSize.setValue(int(settings.value("/TileLayerPlugin/memoryCacheSize", 64, type=int)))
+    self.ui.spinBox_imageCacheSize.setValue(int(settings.value("/TileLayerPlugin/imageCacheSize", 128, type=int)))
+    self.ui.spinBox_diskCacheSize.setValue(int(settings.value("/TileLayerPlugin/diskCacheSize", 256, type=int)))
+    self.ui.spinBox_maxAncestorDistance.setValue(int(settings.value("/TileLayerPlugin/maxAncestorDistance", 4, type=int)))
+    self.ui.spinBox_prefetchTilesPerMinute.setValue(int(settings.value("/TileLayerPlugin/prefetchTilesPerMinute", 120, type=int)))
+    self.ui.spinBox_maxRetries.setValue(int(settings.value("/TileLayerPlugin/maxRetries", 3, type=int)))
+    self.ui.spinBox_negativeCacheTTL.setValue(int(settings.value("/TileLayerPlugin/negativeCacheTTL", 60, type=int)))
+    self.ui.spinBox_decodeThreads.setValue(int(settings.value("/TileLayerPlugin/decodeThreads", QThread.idealThreadCount(), type=int)))
+    self.ui.comboBox_drawMethod.setCurrentIndex(int(settings.value("/TileLayerPlugin/drawMethod", 0, type=int)))
+    self.ui.comboBox_zoomPolicy.setCurrentIndex(int(settings.value("/TileLayerPlugin/zoomPolicy", 0, type=int)))
     self.ui.checkBox_MoveToLayer.setCheckState(int(settings.value("/TileLayerPlugin/moveToLayer", 0, type=int)))
     self.ui.checkBox_NavigationMessages.setCheckState(int(settings.value("/TileLayerPlugin/naviMsg", Qt.Checked, type=int)))
+    self.ui.checkBox_FallbackToChildren.setCheckState(int(settings.value("/TileLayerPlugin/fallbackToChildren", Qt.Checked, type=int)))
+    self.ui.checkBox_ProgressiveRendering.setCheckState(int(settings.value("/TileLayerPlugin/progressiveRendering", Qt.Unchecked, type=int)))
+    self.ui.checkBox_DpiAwareZoom.setCheckState(int(settings.value("/TileLayerPlugin/dpiAwareZoom", Qt.Unchecked, type=int)))
 
   def accept(self):
     QDialog.accept(self)
@@ -46,8 +59,21 @@ class SettingsDialog(QDialog):
     settings = QSettings()
     settings.setValue("/TileLayerPlugin/extDir", self.ui.lineEdit_externalDirectory.text())
     settings.setValue("/TileLayerPlugin/timeout", self.ui.spinBox_downloadTimeout.value())
+    settings.setValue("/TileLayerPlugin/memoryCacheSize", self.ui.spinBox_memoryCacheSize.value())
+    settings.setValue("/TileLayerPlugin/imageCacheSize", self.ui.spinBox_imageCacheSize.value())
+    settings.setValue("/TileLayerPlugin/diskCacheSize", self.ui.spinBox_diskCacheSize.value())
+    settings.setValue("/TileLayerPlugin/maxAncestorDistance", self.ui.spinBox_maxAncestorDistance.value())
+    settings.setValue("/TileLayerPlugin/prefetchTilesPerMinute", self.ui.spinBox_prefetchTilesPerMinute.value())
+    settings.setValue("/TileLayerPlugin/maxRetries", self.ui.spinBox_maxRetries.value())
+    settings.setValue("/TileLayerPlugin/negativeCacheTTL", self.ui.spinBox_negativeCacheTTL.value())
+    settings.setValue("/TileLayerPlugin/decodeThreads", self.ui.spinBox_decodeThreads.value())
+    settings.setValue("/TileLayerPlugin/drawMethod", self.ui.comboBox_drawMethod.currentIndex())
+    settings.setValue("/TileLayerPlugin/zoomPolicy", self.ui.comboBox_zoomPolicy.currentIndex())
     settings.setValue("/TileLayerPlugin/moveToLayer", self.ui.checkBox_MoveToLayer.checkState())
     settings.setValue("/TileLayerPlugin/naviMsg", self.ui.checkBox_NavigationMessages.checkState())
+    settings.setValue("/TileLayerPlugin/fallbackToChildren", self.ui.checkBox_FallbackToChildren.checkState())
+    settings.setValue("/TileLayerPlugin/progressiveRendering", self.ui.checkBox_ProgressiveRendering.checkState())
+    settings.setValue("/TileLayerPlugin/dpiAwareZoom", self.ui.checkBox_DpiAwareZoom.checkState())
 
   def selectExternalDirectory(self):
     # show select directory dialog
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""tests for the range of reprojected chunks which covers the map view"""
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from qgis.core import QgsPoint
+    from rotatedrect import RotatedRect
+    from tilelayer import TileLayer
+except ImportError:
+    QgsPoint = None
+
+
+@unittest.skipIf(QgsPoint is None, "QGIS is not available")
+class ChunkRangeTest(unittest.TestCase):
+
+    CHUNK_SIZE = 128.0
+
+    def assertCovers(self, mapExtent):
+        cxmin, cymin, cxmax, cymax = TileLayer.chunkRange(mapExtent, self.CHUNK_SIZE)
+        for pt in mapExtent.vertices():
+            cx, cy = int(math.floor(pt.x() / self.CHUNK_SIZE)), int(math.floor(-pt.y() / self.CHUNK_SIZE))
+            self.assertTrue(cxmin <= cx <= cxmax and cymin <= cy <= cymax,
+                            "corner {0} is not covered by chunks {1}".format(pt.toString(), (cxmin, cymin, cxmax, cymax)))
+
+    def test_unrotated(self):
+        self.assertCovers(RotatedRect(QgsPoint(1000, -500), 1600, 900))
+
+    def test_rotated(self):
+        # at 90 degrees, the long axis of the view is vertical in the map
+        mapExtent = RotatedRect(QgsPoint(1000, -500), 1600, 900, 90)
+        self.assertCovers(mapExtent)
+        cxmin, cymin, cxmax, cymax = TileLayer.chunkRange(mapExtent, self.CHUNK_SIZE)
+        self.assertGreaterEqual((cymax - cymin + 1) * self.CHUNK_SIZE, 1600)
+
+        for rotation in (30, 45, 135, -60):
+            self.assertCovers(RotatedRect(QgsPoint(1000, -500), 1600, 900, rotation))
+
+
+if __name__ == "__main__":
+    unittest.main()
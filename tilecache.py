@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ TileCache
+   in-memory LRU cache of tile data shared by tile layers
+                              -------------------
+        begin                : 2012-12-16
+        copyright            : (C) 2013 by Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TileCache:
+    """LRU cache with a byte budget. Keys are (layer key, zoom, x, y) tuples.
+    The cache is accessed from both the main thread and render threads."""
+
+    # approximate memory used by an entry besides its data
+    ENTRY_OVERHEAD = 64
+
+    def __init__(self, maxBytes, sizeOf=len):
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._bytes = 0
+        self.resetStats()
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry    # move to the most recently used position
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        """get a value without updating the LRU order and the stats"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[0]
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, value):
+        if value is None:
+            return
+        size = self.sizeOf(value) + self.ENTRY_OVERHEAD
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+
+            if size > self.maxBytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            self._evict()
+
+    def remove(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def removeLayer(self, layerKey):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == layerKey]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def setMaxBytes(self, maxBytes):
+        with self._lock:
+            self.maxBytes = maxBytes
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self.maxBytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[1]
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "bytes": self._bytes,
+                    "maxBytes": self.maxBytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+class NegativeCache:
+    """Remembers tiles which do not exist (e.g. 404 responses) until the entries expire,
+    so that they are not requested again. Keys are (layer key, zoom, x, y) tuples."""
+
+    def __init__(self, ttl, maxEntries=100000):
+        self.ttl = ttl      # seconds. 0 to disable
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict()   # key: expiration time in seconds since the epoch
+        self._lock = threading.RLock()
+        self.resetStats()
+
+    def resetStats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """returns True if the tile is known not to exist"""
+        with self._lock:
+            if self.contains(key):
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def contains(self, key):
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is None:
+                return False
+            if expires <= time.time():
+                del self._entries[key]
+                return False
+            return True
+
+    def put(self, key, expires=None):
+        """remember that the tile does not exist. returns the expiration time, or None if disabled"""
+        if self.ttl <= 0:
+            return None
+        if expires is None:
+            expires = int(time.time()) + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = expires
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+        return expires
+
+    def remove(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def removeLayer(self, layerKey):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == layerKey]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def setTtl(self, ttl):
+        self.ttl = ttl
+        if ttl <= 0:
+            self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses}
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ TileDecoder
+   decodes tile images in a thread pool
+                              -------------------
+        begin                : 2012-12-16
+        copyright            : (C) 2013 by Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import threading
+from PyQt4.QtCore import QRunnable, QThreadPool
+
+from tiles import decodeTileImage
+
+
+class DecodeTask(QRunnable):
+    def __init__(self, decoder, key, data):
+        QRunnable.__init__(self)
+        self.decoder = decoder
+        self.key = key
+        self.data = data
+
+    def run(self):
+        self.decoder._decode(self.key, self.data)
+
+
+class TileDecoder:
+    """Decodes tile data into images in a thread pool, and puts them into the image cache.
+    Tiles are decoded as soon as their data arrives, so that the images are ready when they are drawn."""
+
+    def __init__(self, imageCache, maxThreads):
+        self.imageCache = imageCache
+        self.pool = QThreadPool()
+        self.maxThreads = 0
+        self.setMaxThreadCount(maxThreads)
+
+        self._pending = {}    # key: threading.Event which is set when the tile has been decoded
+        self._lock = threading.Lock()
+        self.decoded = 0
+        self.failed = 0
+
+    def setMaxThreadCount(self, maxThreads):
+        """0 to disable. tiles are decoded in render threads"""
+        self.maxThreads = maxThreads
+        if maxThreads > 0:
+            self.pool.setMaxThreadCount(maxThreads)
+
+    def isEnabled(self):
+        # decoded images are passed through the image cache
+        return self.maxThreads > 0 and self.imageCache.maxBytes > 0
+
+    def decode(self, key, data):
+        """start decoding tile data unless its image is in the image cache or being decoded"""
+        if not data or not self.isEnabled():
+            return
+        with self._lock:
+            if key in self._pending or self.imageCache.contains(key):
+                return
+            self._pending[key] = threading.Event()
+        self.pool.start(DecodeTask(self, key, data))
+
+    def _decode(self, key, data):
+        try:
+            image = decodeTileImage(data)
+            if image is None:
+                self.failed += 1
+            else:
+                self.imageCache.put(key, image)
+                self.decoded += 1
+        finally:
+            # render threads waiting for the tile are released even if decoding has raised an exception
+            with self._lock:
+                event = self._pending.pop(key)
+            event.set()
+
+    def image(self, key):
+        """returns the image of the tile, waiting for decoding in progress. returns None if not available"""
+        with self._lock:
+            event = self._pending.get(key)
+        if event:
+            event.wait()
+        return self.imageCache.peek(key)
+
+    def waitForDone(self):
+        self.pool.waitForDone()
+
+    def stats(self):
+        return {"threads": self.maxThreads,
+                "active": self.pool.activeThreadCount(),
+                "pending": len(self._pending),
+                "decoded": self.decoded,
+                "failed": self.failed}
@@ -22,23 +22,19 @@
 import math
 import os
 import threading
-from PyQt4.QtCore import Qt, QEventLoop, QFile, QObject, QPoint, QPointF, QRect, QRectF, QSettings, QUrl, QTimer, \
+import time
+from collections import OrderedDict
+from PyQt4.QtCore import Qt, QByteArray, QEventLoop, QFile, QObject, QPoint, QPointF, QRect, QRectF, QUrl, QTimer, \
     pyqtSignal, qDebug
-from PyQt4.QtGui import QBrush, QColor, QFont, QImage, QPainter, QMessageBox
-from qgis.core import QGis, QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsGeometry, QgsPluginLayer, \
-    QgsPluginLayerType, QgsRectangle
+from PyQt4.QtGui import QBrush, QColor, QFont, QPainter, QMessageBox
+from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsCsException, QgsGeometry, \
+    QgsMapToPixel, QgsPluginLayer, QgsPluginLayerType, QgsRectangle
 from qgis.gui import QgsMessageBar
 
-try:
-    from osgeo import gdal
-
-    hasGdal = True
-except:
-    hasGdal = False
-
-from downloader import Downloader
+from downloader import Downloader, FetchBatch
 from rotatedrect import RotatedRect
-from tiles import BoundingBox, Tile, TileDefaultSettings, TileLayerDefinition, Tiles
+from tiles import BoundingBox, Mosaic, Tile, TileDefaultSettings, TileLayerDefinition, Tiles, crsKey, decodeTileImage
+from tilesource import createTileSource
 
 debug_mode = 0
 
@@ -46,13 +42,49 @@ debug_mode = 0
 class TileLayer(QgsPluginLayer):
     LAYER_TYPE = "TileLayer"
     MAX_TILE_COUNT = 256
+    PROGRESSIVE_REPAINT_INTERVAL = 200    # ms
+    PROGRESSIVE_REPAINT_TILES = 32
+    PREFETCH_MARGIN = 1                   # tiles around the view
+    DISK_STORE_TILES = 16                 # arrived tiles are written to the disk cache at a time
+    DISK_STORE_INTERVAL = 1000            # ms. or after this time since a tile arrived
+    RENDERING_STOPPED_CHECK_INTERVAL = 100  # ms
+
+    # methods to draw tiles which are not reprojected
+    DRAW_AUTO = 0       # the faster one of the two methods below
+    DRAW_MOSAIC = 1     # draw a mosaic image of the tiles
+    DRAW_DIRECT = 2     # draw each tile onto the map canvas
+    DRAW_TIME_SMOOTHING = 0.2     # weight of the latest draw time in the moving averages
+    DRAW_TRIAL_INTERVAL = 20      # the slower method is measured again at this interval of draws
+
+    # zoom level selection
+    ZOOM_CEIL = 0           # tile pixels are not larger than pixels of the paint device
+    ZOOM_NEAREST = 1        # zoom level nearest to the resolution of the paint device
+    ZOOM_FLOOR = 2          # tile pixels are not smaller than pixels of the paint device
+    ZOOM_FETCH_BUDGET = 3   # one of ceil and floor whose tiles need fewer downloads, if floor is acceptable
+    FETCH_BUDGET_MAX_MAGNIFICATION = 1.5    # max magnification of tiles of the floor zoom level in fetch budget
+    REFERENCE_DPI = 96.0    # resolution for which tiles are designed
+
     DEFAULT_BLEND_MODE = "SourceOver"
     DEFAULT_SMOOTH_RENDER = True
+    DEFAULT_OVERSAMPLING = 2
+
+    # adaptive oversampling
+    ADAPTIVE_OVERSAMPLING_LOW = 1
+    ADAPTIVE_OVERSAMPLING_HIGH = 2
+    ADAPTIVE_IDLE_DELAY = 500     # ms. map is repainted in high resolution after this time since the last change
+
+    # cache of reprojected tiles on the map canvas
+    REPROJECTION_CHUNK_SIZE = 128       # pixels
+    REPROJECTION_LEVELS_PER_OCTAVE = 4  # resolution steps of the chunks
 
     # PyQt signals
-    fetchRequestSignal = pyqtSignal(list)
+    fetchRequestSignal = pyqtSignal(object)
+    progressiveRequestSignal = pyqtSignal(object, dict)
+    prefetchRequestSignal = pyqtSignal(list)
+    revalidateRequestSignal = pyqtSignal(list)
     statusSignal = pyqtSignal(str, int)
     messageBarSignal = pyqtSignal(str, str, int, int)
+    idleRepaintSignal = pyqtSignal()
 
     def __init__(self, plugin, layerDef, creditVisibility=1):
         QgsPluginLayer.__init__(self, TileLayer.LAYER_TYPE, layerDef.title)
@@ -61,6 +93,9 @@ class TileLayer(QgsPluginLayer):
         self.layerDef = layerDef
         self.creditVisibility = 1 if creditVisibility else 0
         self.tiles = None
+        self.mosaic = Mosaic()      # image of the tiles drawn on the map canvas, updated incrementally
+        self.drawTimes = {self.DRAW_MOSAIC: None, self.DRAW_DIRECT: None}   # moving averages of draw time
+        self.drawCount = 0
 
         # set attribution property
         self.setAttribution(layerDef.attribution)
@@ -87,10 +122,7 @@ class TileLayer(QgsPluginLayer):
         if layerDef.bbox:
             if not layerDef.epsg:
                 layerDef.epsg = 4326
-            if layerDef.epsg == 3857 or layerDef.epsg == 900913:
-                self.setExtent(layerDef.bbox.toQgsRectangle())
-            else:
-                self.setExtent(BoundingBox.epsgToMercatorMeters(layerDef.bbox, layerDef.epsg).toQgsRectangle())
+            self.setExtent(layerDef.mercatorBBox().toQgsRectangle())
         else:
             self.setExtent(QgsRectangle(-layerDef.TSIZE1, -layerDef.TSIZE1, layerDef.TSIZE1, layerDef.TSIZE1))
 
@@ -98,16 +130,53 @@ class TileLayer(QgsPluginLayer):
         self.setTransparency(0)
         self.setBlendModeByName(self.DEFAULT_BLEND_MODE)
         self.setSmoothRender(self.DEFAULT_SMOOTH_RENDER)
+        self.setOversampling(self.DEFAULT_OVERSAMPLING if layerDef.oversampling is None else layerDef.oversampling)
 
         # downloader
+        # requests are sent through the download pool shared by all tile layers
         maxConnections = HonestAccess.maxConnections(layerDef.serviceUrl)
-        cacheExpiry = QSettings().value("/qgis/defaultTileExpiry", 24, type=int)
-        userAgent = "QGIS/{0} TileLayerPlugin/{1}".format(QGis.QGIS_VERSION,
-                                                          self.plugin.VERSION)  # will be overwritten in QgsNetworkAccessManager::createRequest() since 2.2
-        self.downloader = Downloader(self, maxConnections, cacheExpiry, userAgent)
+        self.downloader = Downloader(self, maxConnections, pool=plugin.downloadPool)
         if self.iface:
             self.downloader.replyFinished.connect(self.networkReplyFinished)  # download progress
 
+        # tiles which arrived in the main thread are put into the memory caches at once,
+        # and are written to the disk cache in batches
+        self.unsavedTiles = []          # (zoom, x, y, data, expiration, etag, lastModified)
+        self.unsavedMissingTiles = []   # (zoom, x, y, expires)
+        self.diskStoreTimer = QTimer()
+        self.diskStoreTimer.setSingleShot(True)
+        self.diskStoreTimer.setInterval(self.DISK_STORE_INTERVAL)
+        self.diskStoreTimer.timeout.connect(self.flushDiskTiles)
+
+        # progressive rendering
+        self.pendingTiles = {}      # url: (zoom, x, y) of tiles requested without waiting for them (main thread only)
+        self.arrivedTileCount = 0   # number of tiles which arrived after the last repaint
+        self.repaintTimer = QTimer()
+        self.repaintTimer.setSingleShot(True)
+        self.repaintTimer.setInterval(self.PROGRESSIVE_REPAINT_INTERVAL)
+        self.repaintTimer.timeout.connect(self.progressiveRepaint)
+        self.downloader.replyFinished.connect(self.progressiveReplyFinished)
+        self.downloader.allRepliesFinished.connect(self.progressiveRepaint)
+
+        # prefetch
+        self.prefetchTiles = {}     # url: (zoom, x, y) of tiles requested to prefetch
+        self.downloader.prefetchFinished.connect(self.prefetchFinishedSlot)
+
+        # revalidation of expired tiles, which are drawn until they are refreshed
+        self.revalidateTiles = {}   # url: (zoom, x, y) of tiles requested to revalidate
+        self.downloader.revalidateFinished.connect(self.revalidateFinishedSlot)
+
+        # repaint in high resolution for adaptive oversampling
+        self.lastCanvasExtent = None
+        self.idleRepaintTimer = QTimer()
+        self.idleRepaintTimer.setSingleShot(True)
+        self.idleRepaintTimer.setInterval(self.ADAPTIVE_IDLE_DELAY)
+        self.idleRepaintTimer.timeout.connect(self.repaintRequested.emit)
+        self.idleRepaintSignal.connect(self.idleRepaintSlot)
+
+        # tile source which reads local tiles directly
+        self.tileSource = createTileSource(layerDef)
+
         # TOS violation warning
         if HonestAccess.restrictedByTOS(layerDef.serviceUrl):
             QMessageBox.warning(None,
@@ -117,6 +186,9 @@ class TileLayer(QgsPluginLayer):
         # multi-thread rendering
         self.eventLoop = None
         self.fetchRequestSignal.connect(self.fetchRequestSlot)
+        self.progressiveRequestSignal.connect(self.progressiveRequestSlot)
+        self.prefetchRequestSignal.connect(self.prefetchRequestSlot)
+        self.revalidateRequestSignal.connect(self.revalidateRequestSlot)
         if self.iface:
             self.statusSignal.connect(self.showStatusMessageSlot)
             self.messageBarSignal.connect(self.showMessageBarSlot)
@@ -137,6 +209,10 @@ class TileLayer(QgsPluginLayer):
         self.smoothRender = isSmooth
         self.setCustomProperty("smoothRender", 1 if isSmooth else 0)
 
+    def setOversampling(self, oversampling):
+        self.oversampling = oversampling
+        self.setCustomProperty("oversampling", TileLayerDefinition.oversamplingToString(oversampling))
+
     def setCreditVisibility(self, visible):
         self.creditVisibility = visible
         self.setCustomProperty("creditVisibility", 1 if visible else 0)
@@ -179,8 +255,8 @@ class TileLayer(QgsPluginLayer):
 
             transform = renderContext.coordinateTransform()
             if transform:
-                transform = QgsCoordinateTransform(transform.destCRS(),
-                                                   transform.sourceCrs())  # project CRS to layer CRS (EPSG:3857)
+                transform = self.plugin.transformCache.transform(transform.destCRS(),
+                                                                 transform.sourceCrs())  # project CRS to layer CRS (EPSG:3857)
                 geometry = QgsGeometry.fromPolyline(
                     [map2pixel.toMapCoordinatesF(cx - 0.5, cy), map2pixel.toMapCoordinatesF(cx + 0.5, cy)])
                 geometry.transform(transform)
@@ -200,8 +276,7 @@ class TileLayer(QgsPluginLayer):
             extent = mapExtent.boundingBox()
 
         # calculate zoom level
-        tile_mpp1 = self.layerDef.TSIZE1 / self.layerDef.TILE_SIZE
-        zoom = int(math.ceil(math.log(tile_mpp1 / mpp, 2) + 1))
+        zoom = self.selectZoom(renderContext, mpp, extent)
         zoom = max(0, min(zoom, self.layerDef.zmax))
         # zoom = max(self.layerDef.zmin, zoom)
 
@@ -225,12 +300,7 @@ class TileLayer(QgsPluginLayer):
 
             # bounding box limit
             if self.layerDef.bbox:
-                if not self.layerDef.epsg:
-                    self.layerDef.epsg = 4326
-                elif self.layerDef.epsg == 3857 or self.layerDef.epsg == 900913:
-                    trange = self.layerDef.bboxMercatorToTileRange(zoom, self.layerDef.bbox)
-                else:
-                    trange = self.layerDef.epsgToTileRange(zoom, self.layerDef.bbox)
+                trange = self.layerDef.bboxTileRange(zoom)
                 ulx = max(ulx, trange.xmin)
                 uly = max(uly, trange.ymin)
                 lrx = min(lrx, trange.xmax)
@@ -255,8 +325,25 @@ class TileLayer(QgsPluginLayer):
             # zoom level has been determined
             break
 
+        if not isWebMercator and self.isChunkCacheEnabled(renderContext):
+            # reprojected chunks extend beyond the view. tiles under them are also needed to cache the chunks
+            margin = int(math.ceil(self.REPROJECTION_CHUNK_SIZE * mpp / size))
+            mulx, muly = max(0, ulx - margin), max(0, uly - margin)
+            mlrx, mlry = min(lrx + margin, matrixSize - 1), min(lry + margin, matrixSize - 1)
+            if self.layerDef.bbox:
+                mulx, muly = max(mulx, trange.xmin), max(muly, trange.ymin)
+                mlrx, mlry = min(mlrx, trange.xmax), min(mlry, trange.ymax)
+
+            # the margin is not added if the tile count gets over the limit
+            if (mlrx - mulx + 1) * (mlry - muly + 1) <= self.MAX_TILE_COUNT:
+                ulx, uly, lrx, lry = mulx, muly, mlrx, mlry
+
         self.logT("TileLayer.draw: {0} {1} {2} {3} {4}".format(zoom, ulx, uly, lrx, lry))
 
+        # center of the view in tile coordinates. tiles near the center are downloaded first
+        center = extent.center()
+        centerTile = ((center.x() + self.layerDef.TSIZE1) / size, (self.layerDef.TSIZE1 - center.y()) / size)
+
         # save painter state
         painter.save()
 
@@ -272,25 +359,83 @@ class TileLayer(QgsPluginLayer):
         else:
             # create Tiles class object and throw url into it
             tiles = Tiles(zoom, ulx, uly, lrx, lry, self.layerDef)
-            urls = []
+            tileCache = self.plugin.tileCache
+            imageCache = self.plugin.imageCache
+            negativeCache = self.plugin.negativeCache
+            missing = OrderedDict()
             cacheHits = 0
             for ty in range(uly, lry + 1):
                 for tx in range(ulx, lrx + 1):
-                    data = None
                     url = self.layerDef.tileUrl(zoom, tx, ty)
-                    if self.tiles and zoom == self.tiles.zoom and url in self.tiles.tiles:
-                        data = self.tiles.tiles[url].data
-                    tiles.addTile(url, Tile(zoom, tx, ty, data))
+                    key = self.cacheKey(zoom, tx, ty)
+                    image = imageCache.get(key)
+                    if image is None:
+                        data = tileCache.get(key)
+                        if data is None and negativeCache.get(key):
+                            data = QByteArray()     # tile does not exist
+                    else:
+                        # decoded image is available. data is not needed
+                        data = ""
+                        cacheHits += 1
+                    tiles.addTile(url, Tile(zoom, tx, ty, data, image))
+                    if image is not None:
+                        continue
                     if data is None:
-                        urls.append(url)
+                        missing[(tx, ty)] = url
                     elif data:  # memory cache exists
                         cacheHits += 1
                         # else:    # tile not found
 
+            # read local tiles from the tile source
+            if missing and self.tileSource:
+                found = self.tileSource.readTiles(zoom, ulx, uly, lrx, lry, missing)
+                if found is None:
+                    # failed to read. nothing is cached, so that the tiles are read again in the next draw
+                    for url in missing.itervalues():
+                        tiles.setImageData(url, QByteArray())
+                    missing.clear()
+                else:
+                    for (tx, ty), data in found.iteritems():
+                        tiles.setImageData(missing.pop((tx, ty)), data)
+                        tileCache.put(self.cacheKey(zoom, tx, ty), data)
+
+            # look up tiles that are not in memory in the disk cache
+            diskStore = self.diskStore()
+            if missing and diskStore:
+                stale = {}
+                found = diskStore.getRange(zoom, ulx, uly, lrx, lry, missing, stale)
+                for (tx, ty), data in found.iteritems():
+                    tiles.setImageData(missing.pop((tx, ty)), data)
+                    tileCache.put(self.cacheKey(zoom, tx, ty), data)
+                cacheHits += len(found)
+
+                # expired tiles are drawn as they are, and refreshed in background
+                revalidate = []
+                for (tx, ty), (data, etag, lastModified) in stale.iteritems():
+                    url = missing.pop((tx, ty))
+                    tiles.setImageData(url, data)
+                    tileCache.put(self.cacheKey(zoom, tx, ty), data)
+                    revalidate.append((url, zoom, tx, ty, etag, lastModified))
+                if revalidate:
+                    self.revalidateRequestSignal.emit(revalidate)
+
+                for (tx, ty), expires in diskStore.getMissing(zoom, ulx, uly, lrx, lry, missing).iteritems():
+                    tiles.setImageData(missing.pop((tx, ty)), QByteArray())
+                    negativeCache.put(self.cacheKey(zoom, tx, ty), expires)
+            urls = missing.values()
+            priorities = dict((url, self.tilePriority(zoom, centerTile, zoom, tx, ty)) for (tx, ty), url in missing.iteritems())
+
+            tiles.setFallback(self.findCachedImage, self.plugin.maxAncestorDistance, self.plugin.fallbackToChildren)
             self.tiles = tiles
-            if len(urls) > 0:
+            if len(urls) > 0 and self.plugin.progressiveRendering and self.isCanvasRendering(renderContext):
+                # request tiles without waiting for them. the layer is repainted as they arrive
+                if any(not self.downloader.isPending(url) for url in urls):
+                    pendingTiles = dict((url, (zoom, tx, ty)) for (tx, ty), url in missing.iteritems())
+                    self.progressiveRequestSignal.emit(self.createFetchBatch(urls, priorities), pendingTiles)
+
+            elif len(urls) > 0:
                 # fetch tile data
-                files = self.fetchFiles(urls)
+                files = self.fetchFiles(urls, priorities)
                 for url in files.keys():
                     self.tiles.setImageData(url, files[url])
 
@@ -298,6 +443,8 @@ class TileLayer(QgsPluginLayer):
                     stats = self.downloader.stats()
                     allCacheHits = cacheHits + stats["cacheHits"]
                     msg = self.tr("{0} files downloaded. {1} caches hit.").format(stats["downloaded"], allCacheHits)
+                    if stats["notFound"]:
+                        msg += self.tr(" {0} tiles not found.").format(stats["notFound"])
                     barmsg = None
                     if self.downloader.errorStatus != Downloader.NO_ERROR:
                         if self.downloader.errorStatus == Downloader.TIMEOUT_ERROR:
@@ -311,6 +458,9 @@ class TileLayer(QgsPluginLayer):
                     if barmsg:
                         self.showMessageBar(barmsg, QgsMessageBar.WARNING, 4)
 
+            # wait for tile images decoded in the thread pool
+            self.decodeTiles(self.tiles)
+
             # apply layer style
             oldOpacity = painter.opacity()
             painter.setOpacity(0.01 * (100 - self.transparency))
@@ -318,14 +468,45 @@ class TileLayer(QgsPluginLayer):
             if self.smoothRender:
                 painter.setRenderHint(QPainter.SmoothPixmapTransform)
 
-            # draw tiles
-            if isWebMercator and rotation == 0:
-                # no need to reproject tiles
-                self.drawTiles(renderContext, self.tiles)
-                # self.drawTilesDirectly(renderContext, self.tiles)
-            else:
-                # reproject tiles
-                self.drawTilesOnTheFly(renderContext, mapExtent, self.tiles)
+            # draw tiles. the mosaic is used for map canvas rendering, by one thread at a time
+            canvasRendering = self.isCanvasRendering(renderContext)
+            directly = isWebMercator and canvasRendering and self.selectDrawMethod() == self.DRAW_DIRECT
+            mosaic = None
+            if canvasRendering and not directly and self.mosaic.lock.acquire(False):
+                mosaic = self.mosaic
+            try:
+                if isWebMercator:
+                    # no need to reproject tiles. if the map is rotated, the painter is rotated instead
+                    startTime = time.time()
+                    unrotated = None
+                    if rotation:
+                        painter.save()
+                        unrotated = self.rotatePainter(renderContext, mapExtent)
+                    if directly:
+                        self.drawTilesDirectly(renderContext, self.tiles, map2pixel=unrotated)
+                        self.updateDrawTime(self.DRAW_DIRECT, time.time() - startTime)
+                    else:
+                        self.drawTiles(renderContext, self.tiles, mosaic=mosaic, map2pixel=unrotated)
+                        if mosaic is not None:
+                            self.updateDrawTime(self.DRAW_MOSAIC, time.time() - startTime)
+                    if rotation:
+                        painter.restore()
+                elif mosaic is not None and self.plugin.warpEngine is not None:
+                    # reproject tiles, reusing reprojected chunks drawn before
+                    self.drawTilesInChunks(renderContext, mapExtent, self.tiles, mosaic)
+                else:
+                    # reproject tiles
+                    self.drawTilesOnTheFly(renderContext, mapExtent, self.tiles, mosaic=mosaic)
+            finally:
+                if mosaic is not None:
+                    mosaic.lock.release()
+
+            # keep decoded images for following repaints
+            self.storeImagesToCache(self.tiles)
+
+            # request tiles which are likely to be drawn next
+            if self.isCanvasRendering(renderContext):
+                self.prefetch(zoom, ulx, uly, lrx, lry, centerTile)
 
             # restore layer style
             painter.setOpacity(oldOpacity)
@@ -354,12 +535,13 @@ class TileLayer(QgsPluginLayer):
 
         return True
 
-    def drawTiles(self, renderContext, tiles, sdx=1.0, sdy=1.0):
+    def drawTiles(self, renderContext, tiles, sdx=1.0, sdy=1.0, mosaic=None, map2pixel=None):
         # create an image that has the same resolution as the tiles
-        image = tiles.image()
+        image = tiles.image(mosaic)
 
         # tile extent to pixel
-        map2pixel = renderContext.mapToPixel()
+        if map2pixel is None:
+            map2pixel = renderContext.mapToPixel()
         extent = tiles.extent()
         topLeft = map2pixel.transform(extent.xMinimum(), extent.yMaximum())
         bottomRight = map2pixel.transform(extent.xMaximum(), extent.yMinimum())
@@ -372,9 +554,9 @@ class TileLayer(QgsPluginLayer):
         self.log("Tiles extent: " + str(extent))
         self.log("Draw into canvas rect: " + str(rect))
 
-    def drawTilesOnTheFly(self, renderContext, mapExtent, tiles, sdx=1.0, sdy=1.0):
-        if not hasGdal:
-            msg = self.tr("Rotation/Reprojection requires python-gdal")
+    def drawTilesOnTheFly(self, renderContext, mapExtent, tiles, sdx=1.0, sdy=1.0, mosaic=None):
+        if self.plugin.warpEngine is None:
+            msg = self.tr("Rotation/Reprojection requires python-gdal or numpy")
             self.showMessageBar(msg, QgsMessageBar.INFO, 2)
             return
 
@@ -386,56 +568,297 @@ class TileLayer(QgsPluginLayer):
             sourceCrs = destCrs = self.crs()
 
         # create image from the tiles
-        image = tiles.image()
+        image = tiles.image(mosaic)
 
         # tile extent
         extent = tiles.extent()
         geotransform = [extent.xMinimum(), extent.width() / image.width(), 0, extent.yMaximum(), 0,
                         -extent.height() / image.height()]
 
-        # source raster dataset
-        driver = gdal.GetDriverByName("MEM")
-        tile_ds = driver.Create("", image.width(), image.height(), 1, gdal.GDT_UInt32)
-        tile_ds.SetProjection(str(sourceCrs.toWkt()))
-        tile_ds.SetGeoTransform(geotransform)
-
-        # QImage to raster
-        ba = image.bits().asstring(image.numBytes())
-        tile_ds.GetRasterBand(1).WriteRaster(0, 0, image.width(), image.height(), ba)
-
-        # target raster size - if smoothing is enabled, create raster of twice each of width and height of viewport size
+        # target raster size - if smoothing is enabled, create raster larger than viewport size
         # in order to get high quality image
-        oversampl = 2 if self.smoothRender else 1
+        oversampl = self.reprojectionOversampling(renderContext)
 
         painter = renderContext.painter()
         viewport = painter.viewport()
-        width, height = viewport.width() * oversampl, viewport.height() * oversampl
-
-        # target raster dataset
-        canvas_ds = driver.Create("", width, height, 1, gdal.GDT_UInt32)
-        canvas_ds.SetProjection(str(destCrs.toWkt()))
-        canvas_ds.SetGeoTransform(mapExtent.geotransform(width, height, is_grid_point=False))
+        width, height = int(viewport.width() * oversampl), int(viewport.height() * oversampl)
 
         # reproject image
-        gdal.ReprojectImage(tile_ds, canvas_ds)
-
-        # raster to QImage
-        ba = canvas_ds.GetRasterBand(1).ReadRaster(0, 0, width, height)
-        reprojected_image = QImage(ba, width, height, QImage.Format_ARGB32_Premultiplied)
+        reprojected_image = self.plugin.warpEngine.reproject(image, geotransform, sourceCrs, width, height,
+                                                             mapExtent.geotransform(width, height, is_grid_point=False),
+                                                             destCrs, None if self.smoothRender else "near")
 
         # draw the image on the map canvas
         rect = QRectF(QPointF(0, 0), QPointF(viewport.width() * sdx, viewport.height() * sdy))
         painter.drawImage(rect, reprojected_image)
 
-    def drawTilesDirectly(self, renderContext, tiles, sdx=1.0, sdy=1.0):
+    def drawTilesInChunks(self, renderContext, mapExtent, tiles, mosaic):
+        """reproject tiles in chunks aligned to a pixel grid in the destination CRS. reprojected chunks are cached,
+        so that only chunks which are newly visible or whose tiles have changed are reprojected"""
+        transform = renderContext.coordinateTransform()
+        sourceCrs, destCrs = transform.sourceCrs(), transform.destCRS()
+
+        # create image from the tiles
+        image = tiles.image(mosaic)
+        extent = tiles.extent()
+        geotransform = [extent.xMinimum(), extent.width() / image.width(), 0, extent.yMaximum(), 0,
+                        -extent.height() / image.height()]
+
+        # resolution of the chunks is rounded to a resolution level
+        mupp = renderContext.mapToPixel().mapUnitsPerPixel()
+        level = int(round(math.log(mupp / self.reprojectionOversampling(renderContext), 2) *
+                          self.REPROJECTION_LEVELS_PER_OCTAVE))
+        res = 2 ** (float(level) / self.REPROJECTION_LEVELS_PER_OCTAVE)
+        chunkPixels = self.REPROJECTION_CHUNK_SIZE
+        chunkSize = chunkPixels * res
+
+        # chunks which intersect with the view (cy increases downward)
+        cxmin, cymin, cxmax, cymax = self.chunkRange(mapExtent, chunkSize)
+
+        cache = self.plugin.reprojectionCache if self.isChunkCacheEnabled(renderContext) else None
+        resampling = None if self.smoothRender else "near"
+        chunks = {}
+        missing = {}
+        for cy in range(cymin, cymax + 1):
+            for cx in range(cxmin, cxmax + 1):
+                key = signature = None
+                if cache is not None:
+                    key = (self.layerDef.serviceUrl, tiles.zoom, crsKey(destCrs), level, resampling, cx, cy)
+                    signature = self.chunkSignature(transform, tiles, mosaic, cx * chunkSize, -cy * chunkSize, chunkSize)
+                cached = cache.get(key) if signature is not None else None
+                if cached is not None and cached[0] == signature:
+                    chunks[(cx, cy)] = cached[1]
+                else:
+                    missing[(cx, cy)] = (key, signature)
+
+        # reproject each horizontal run of missing chunks at once, and split it into the chunks. runs of the same
+        # range in consecutive rows are joined. cached chunks between missing ones are not reprojected again
+        runs = []
+        for cx, cy in sorted(missing, key=lambda c: (c[1], c[0])):
+            if runs and runs[-1][3] == cy and runs[-1][2] == cx - 1:
+                runs[-1][2] = cx
+            else:
+                runs.append([cx, cy, cx, cy])
+        blocks = []
+        lastBlocks = {}
+        for run in runs:
+            block = lastBlocks.get((run[0], run[2]))
+            if block is not None and block[3] == run[1] - 1:
+                block[3] = run[3]
+            else:
+                blocks.append(run)
+                lastBlocks[(run[0], run[2])] = run
+        for bxmin, bymin, bxmax, bymax in blocks:
+            reprojected = self.plugin.warpEngine.reproject(image, geotransform, sourceCrs,
+                                                           (bxmax - bxmin + 1) * chunkPixels,
+                                                           (bymax - bymin + 1) * chunkPixels,
+                                                           [bxmin * chunkSize, res, 0, -bymin * chunkSize, 0, -res],
+                                                           destCrs, resampling)
+            for cy in range(bymin, bymax + 1):
+                for cx in range(bxmin, bxmax + 1):
+                    chunk = reprojected.copy((cx - bxmin) * chunkPixels, (cy - bymin) * chunkPixels, chunkPixels, chunkPixels)
+                    chunks[(cx, cy)] = chunk
+                    key, signature = missing[(cx, cy)]
+                    if signature is not None:
+                        cache.put(key, (signature, chunk))
+
+        # draw the chunks. if the map is rotated, the painter is rotated
+        painter = renderContext.painter()
+        rotation = mapExtent.rotation()
+        if rotation:
+            painter.save()
+            map2pixel = self.rotatePainter(renderContext, mapExtent)
+        else:
+            map2pixel = renderContext.mapToPixel()
+        for (cx, cy), chunk in chunks.iteritems():
+            # snap chunk edges to pixels so that adjacent chunks neither overlap nor leave seams
+            topLeft = map2pixel.transform(cx * chunkSize, -cy * chunkSize)
+            bottomRight = map2pixel.transform((cx + 1) * chunkSize, -(cy + 1) * chunkSize)
+            left, top = int(round(topLeft.x())), int(round(topLeft.y()))
+            painter.drawImage(QRect(left, top, int(round(bottomRight.x())) - left, int(round(bottomRight.y())) - top),
+                              chunk)
+        if rotation:
+            painter.restore()
+        self.log("Reprojected chunks: {0} cached, {1} reprojected in {2} blocks".format(len(chunks) - len(missing), len(missing),
+                                                                                        len(blocks)))
+
+    @staticmethod
+    def chunkRange(mapExtent, chunkSize):
+        """returns the range of chunks (cxmin, cymin, cxmax, cymax) which covers the extent. cy increases downward.
+        if the map is rotated, the range covers the bounding box of the rotated extent"""
+        rect = mapExtent.boundingBox()
+        return (int(math.floor(rect.xMinimum() / chunkSize)), int(math.floor(-rect.yMaximum() / chunkSize)),
+                int(math.floor(rect.xMaximum() / chunkSize)), int(math.floor(-rect.yMinimum() / chunkSize)))
+
+    def isChunkCacheEnabled(self, renderContext):
+        # reprojected chunks are cached for repaints of the map canvas
+        return (self.plugin.warpEngine is not None and self.plugin.reprojectionCache.maxBytes > 0 and
+                self.isCanvasRendering(renderContext))
+
+    def chunkSignature(self, transform, tiles, mosaic, x, y, size):
+        """returns a tuple of the cache keys of the tile images painted in the mosaic under a chunk,
+        whose top-left corner is (x, y) in the destination CRS. returns None if the chunk is incomplete"""
+        try:
+            points = [transform.transform(x + size * i / 2, y - size * j / 2, QgsCoordinateTransform.ReverseTransform)
+                      for i in range(3) for j in range(3)]
+        except QgsCsException:
+            return None
+
+        # tiles under the chunk, with a margin of source pixels used in resampling
+        zoom = tiles.zoom
+        margin = 2 * self.layerDef.TSIZE1 / (2 ** zoom * self.layerDef.TILE_SIZE)
+        xmin, ymin = self.layerDef.coordsToTile(zoom, min(p.x() for p in points) - margin, max(p.y() for p in points) + margin)
+        xmax, ymax = self.layerDef.coordsToTile(zoom, max(p.x() for p in points) + margin, min(p.y() for p in points) - margin)
+        matrixSize = 2 ** zoom
+        xmin, ymin, xmax, ymax = max(0, xmin), max(0, ymin), min(xmax, matrixSize - 1), min(ymax, matrixSize - 1)
+        if xmin < tiles.xmin or ymin < tiles.ymin or xmax > tiles.xmax or ymax > tiles.ymax:
+            return None
+
+        keys = []
+        for ty in range(ymin, ymax + 1):
+            for tx in range(xmin, xmax + 1):
+                key = mosaic.painted.get((tx, ty))
+                if key is None:
+                    return None     # loading
+                keys.append(key)
+        return tuple(keys)
+
+    def reprojectionOversampling(self, renderContext):
+        if not self.smoothRender:
+            return 1
+        if self.oversampling != TileLayerDefinition.OVERSAMPLING_ADAPTIVE:
+            return self.oversampling
+        if not self.isCanvasRendering(renderContext):
+            return self.ADAPTIVE_OVERSAMPLING_HIGH      # printing
+
+        # low resolution while the map view is changing. the map is repainted in high resolution when it gets idle
+        extent = renderContext.extent()
+        if extent == self.lastCanvasExtent:
+            return self.ADAPTIVE_OVERSAMPLING_HIGH
+        self.lastCanvasExtent = QgsRectangle(extent)
+        self.idleRepaintSignal.emit()
+        return self.ADAPTIVE_OVERSAMPLING_LOW
+
+    def idleRepaintSlot(self):
+        self.idleRepaintTimer.start()
+
+    def drawTilesDirectly(self, renderContext, tiles, sdx=1.0, sdy=1.0, map2pixel=None):
         p = renderContext.painter()
-        for url, tile in tiles.tiles.items():
-            self.log("Draw tile: zoom: %d, x:%d, y:%d, data:%s" % (tile.zoom, tile.x, tile.y, str(tile.data)))
-            rect = self.getTileRect(renderContext, tile.zoom, tile.x, tile.y, sdx, sdy)
-            if tile.data:
-                image = QImage()
-                image.loadFromData(tile.data)
+
+        # tiles outside the clip region are not drawn (compared in device coordinates as the painter may be rotated)
+        transform = p.worldTransform()
+        clipRect = transform.mapRect(p.clipRegion().boundingRect()) if p.hasClipping() else p.viewport()
+        for tile in tiles.tiles.values():
+            # snap tile edges to pixels so that adjacent tiles neither overlap nor leave seams
+            r = self.getTileRect(renderContext, tile.zoom, tile.x, tile.y, sdx, sdy, toInt=False, map2pixel=map2pixel)
+            left, top = int(round(r.left())), int(round(r.top()))
+            rect = QRect(left, top, int(round(r.right())) - left, int(round(r.bottom())) - top)
+            if not transform.mapRect(rect).intersects(clipRect):
+                continue
+
+            image = tile.toImage()
+            if image is not None:
                 p.drawImage(rect, image)
+            elif tile.data is None and tiles.findImage:
+                # tile is still loading or failed to load
+                tiles.drawFallback(p, rect, tile)
+
+    def rotatePainter(self, renderContext, mapExtent):
+        """rotate the painter around the center of the viewport by the map rotation.
+        returns a QgsMapToPixel which maps coordinates to pixels of the unrotated map"""
+        painter = renderContext.painter()
+        viewport = painter.viewport()
+        cx, cy = 0.5 * viewport.width(), 0.5 * viewport.height()
+        painter.translate(cx, cy)
+        painter.rotate(mapExtent.rotation())
+        painter.translate(-cx, -cy)
+
+        center = mapExtent.center()
+        return QgsMapToPixel(renderContext.mapToPixel().mapUnitsPerPixel(), center.x(), center.y(),
+                             viewport.width(), viewport.height(), 0)
+
+    def selectDrawMethod(self):
+        method = self.plugin.drawMethod
+        if method != self.DRAW_AUTO:
+            return method
+
+        # fallback images overlap in direct drawing, which is visible with transparency
+        if self.transparency:
+            return self.DRAW_MOSAIC
+
+        # measure both methods first. then use the faster one, measuring the other occasionally
+        # because the result depends on the situation (e.g. panning, zooming or tile count)
+        mosaicTime, directTime = self.drawTimes[self.DRAW_MOSAIC], self.drawTimes[self.DRAW_DIRECT]
+        if mosaicTime is None:
+            return self.DRAW_MOSAIC
+        if directTime is None:
+            return self.DRAW_DIRECT
+        faster, slower = (self.DRAW_MOSAIC, self.DRAW_DIRECT) if mosaicTime <= directTime else (self.DRAW_DIRECT, self.DRAW_MOSAIC)
+        self.drawCount += 1
+        return slower if self.drawCount % self.DRAW_TRIAL_INTERVAL == 0 else faster
+
+    def updateDrawTime(self, method, elapsed):
+        average = self.drawTimes[method]
+        if average is None:
+            self.drawTimes[method] = elapsed
+        else:
+            self.drawTimes[method] = average + self.DRAW_TIME_SMOOTHING * (elapsed - average)
+        self.log("Draw time ({0}): {1:.1f} ms".format("direct" if method == self.DRAW_DIRECT else "mosaic", elapsed * 1000))
+
+    def selectZoom(self, renderContext, mpp, extent, policy=None):
+        """returns the zoom level of tiles to draw in the view by the zoom policy of the plugin (ZOOM_*).
+        mpp: meters per pixel of the paint device, extent: bounding box of the view in EPSG:3857"""
+        if policy is None:
+            policy = self.plugin.zoomPolicy
+        z = self.fractionalZoom(mpp * self.devicePixelRatio(renderContext))
+        if policy == self.ZOOM_NEAREST:
+            return int(math.floor(z + 0.5))
+        if policy == self.ZOOM_FLOOR:
+            return int(math.floor(z))
+
+        zoom = int(math.ceil(z))
+        if policy == self.ZOOM_FETCH_BUDGET and zoom <= self.layerDef.zmax and zoom - 1 >= max(0, self.layerDef.zmin) \
+                and 2 ** (z - zoom + 1) <= self.FETCH_BUDGET_MAX_MAGNIFICATION:
+            # bytes to download are estimated by the number of tiles which are not cached
+            count = self.uncachedTileCount(zoom, extent)
+            if count is None or self.uncachedTileCount(zoom - 1, extent) < count:
+                return zoom - 1
+        return zoom
+
+    def fractionalZoom(self, mpp):
+        """returns the zoom level (not rounded) at which a tile pixel has the size of mpp meters"""
+        return math.log(self.layerDef.TSIZE1 / self.layerDef.TILE_SIZE / mpp, 2) + 1
+
+    def devicePixelRatio(self, renderContext):
+        """returns the ratio of the paint device resolution (high-DPI screen or printer) to the reference resolution.
+        returns 1 if zoom levels are selected by device pixels"""
+        if not self.plugin.dpiAwareZoom:
+            return 1.0
+        return renderContext.painter().device().logicalDpiX() / self.REFERENCE_DPI
+
+    def uncachedTileCount(self, zoom, extent):
+        """returns the number of tiles in the extent which are in none of the caches.
+        returns None if the tile count is over the limit"""
+        size = self.layerDef.TSIZE1 / 2 ** (zoom - 1)
+        ulx, uly, lrx, lry = self.clipTileRange(zoom, int((extent.xMinimum() + self.layerDef.TSIZE1) / size),
+                                                int((self.layerDef.TSIZE1 - extent.yMaximum()) / size),
+                                                int((extent.xMaximum() + self.layerDef.TSIZE1) / size),
+                                                int((self.layerDef.TSIZE1 - extent.yMinimum()) / size))
+        if lrx < ulx or lry < uly or self.tileSource:
+            return 0
+        if (lrx - ulx + 1) * (lry - uly + 1) > self.MAX_TILE_COUNT:
+            return None
+
+        diskStore = self.diskStore()
+        stored = diskStore.tilesInRange(zoom, ulx, uly, lrx, lry) if diskStore else set()
+        count = 0
+        for ty in range(uly, lry + 1):
+            for tx in range(ulx, lrx + 1):
+                key = self.cacheKey(zoom, tx, ty)
+                if not ((tx, ty) in stored or self.plugin.imageCache.contains(key) or
+                        self.plugin.tileCache.contains(key) or self.plugin.negativeCache.contains(key)):
+                    count += 1
+        return count
 
     def drawDebugInfo(self, renderContext, zoom, ulx, uly, lrx, lry):
         painter = renderContext.painter()
@@ -505,10 +928,10 @@ class TileLayer(QgsPluginLayer):
         scaleY = bottomRight.y() / viewport.height()
         return scaleX, scaleY
 
-    def getTileRect(self, renderContext, zoom, x, y, sdx=1.0, sdy=1.0, toInt=True):
+    def getTileRect(self, renderContext, zoom, x, y, sdx=1.0, sdy=1.0, toInt=True, map2pixel=None):
         """ get tile pixel rect in the render context """
         r = self.layerDef.getTileRect(zoom, x, y)
-        map2pix = renderContext.mapToPixel()
+        map2pix = map2pixel if map2pixel is not None else renderContext.mapToPixel()
         topLeft = map2pix.transform(r.xMinimum(), r.yMaximum())
         bottomRight = map2pix.transform(r.xMaximum(), r.yMinimum())
         if toInt:
@@ -518,6 +941,9 @@ class TileLayer(QgsPluginLayer):
             return QRectF(QPointF(topLeft.x() * sdx, topLeft.y() * sdy),
                           QPointF(bottomRight.x() * sdx, bottomRight.y() * sdy))
 
+    def cacheKey(self, zoom, x, y):
+        return (self.layerDef.serviceUrl, zoom, x, y)
+
     def isProjectCrsWebMercator(self):
         mapSettings = self.iface.mapCanvas().mapSettings() if self.plugin.apiChanged23 else self.iface.mapCanvas().mapRenderer()
         return mapSettings.destinationCrs().postgisSrid() == 3857
@@ -546,18 +972,32 @@ class TileLayer(QgsPluginLayer):
             if not self.layerDef.epsg:
                 self.layerDef.epsg = 4326
             self.layerDef.bbox = BoundingBox.fromString(bbox)
-            self.setExtent(BoundingBox.epsgToMercatorMeters(self.layerDef.bbox).toQgsRectangle())
+            self.setExtent(self.layerDef.mercatorBBox().toQgsRectangle())
 
         # layer style
         self.setTransparency(int(self.customProperty("transparency", 0)))
         self.setBlendModeByName(self.customProperty("blendMode", self.DEFAULT_BLEND_MODE))
         self.setSmoothRender(int(self.customProperty("smoothRender", self.DEFAULT_SMOOTH_RENDER)))
+        try:
+            self.setOversampling(TileLayerDefinition.parseOversampling(self.customProperty("oversampling", "")))
+        except ValueError:
+            self.setOversampling(self.DEFAULT_OVERSAMPLING)
         self.creditVisibility = int(self.customProperty("creditVisibility", 1))
 
         # max connections of downloader
         self.downloader.maxConnections = HonestAccess.maxConnections(self.layerDef.serviceUrl)
+
+        # tile source
+        self.closeTileSource()
+        self.mosaic.clear()
+        self.tileSource = createTileSource(self.layerDef)
         return True
 
+    def closeTileSource(self):
+        if self.tileSource:
+            self.tileSource.close()
+            self.tileSource = None
+
     def writeXml(self, node, doc):
         element = node.toElement();
         element.setAttribute("type", "plugin")
@@ -586,50 +1026,311 @@ class TileLayer(QgsPluginLayer):
         lines.append(fmt % (self.tr("Layer Extent"), extent))
         return "\n".join(lines)
 
+    def clipTileRange(self, zoom, xmin, ymin, xmax, ymax):
+        # clip tile range with the tile matrix and the bounding box of the layer
+        matrixSize = 2 ** zoom
+        xmin, ymin = max(0, xmin), max(0, ymin)
+        xmax, ymax = min(xmax, matrixSize - 1), min(ymax, matrixSize - 1)
+        if self.layerDef.bbox:
+            trange = self.layerDef.bboxTileRange(zoom)
+            xmin, ymin = max(xmin, trange.xmin), max(ymin, trange.ymin)
+            xmax, ymax = min(xmax, trange.xmax), min(ymax, trange.ymax)
+        return xmin, ymin, xmax, ymax
+
+    def tilePriority(self, zoom, centerTile, z, x, y):
+        # squared distance from the center of the view (in tile coordinates of zoom) to the center of tile (z, x, y)
+        scale = 2.0 ** (zoom - z)
+        return ((x + 0.5) * scale - centerTile[0]) ** 2 + ((y + 0.5) * scale - centerTile[1]) ** 2
+
+    def prefetch(self, zoom, ulx, uly, lrx, lry, centerTile):
+        """request tiles around the view and tiles of adjacent zoom levels in idle time"""
+        if self.tileSource or self.plugin.prefetchTilesPerMinute <= 0 or \
+                not HonestAccess.prefetchAllowed(self.layerDef.serviceUrl):
+            return
+
+        # tiles of lower zoom level are fetched first since they can be used to fill tiles which are not available,
+        # then tiles around the view, and tiles of higher zoom level
+        m = self.PREFETCH_MARGIN
+        ranges = [(zoom - 1, ulx // 2, uly // 2, lrx // 2, lry // 2, 0),
+                  (zoom, ulx - m, uly - m, lrx + m, lry + m, 10000),
+                  (zoom + 1, ulx * 2, uly * 2, lrx * 2 + 1, lry * 2 + 1, 20000)]
+
+        tileCache = self.plugin.tileCache
+        negativeCache = self.plugin.negativeCache
+        diskStore = self.diskStore()
+        tiles = []
+        for z, xmin, ymin, xmax, ymax, basePriority in ranges:
+            if z < self.layerDef.zmin or z > self.layerDef.zmax:
+                continue
+            xmin, ymin, xmax, ymax = self.clipTileRange(z, xmin, ymin, xmax, ymax)
+            if xmax < xmin or ymax < ymin:
+                continue
+
+            stored = set()
+            if diskStore:
+                stored = diskStore.tilesInRange(z, xmin, ymin, xmax, ymax)
+                stored.update(diskStore.getMissing(z, xmin, ymin, xmax, ymax))
+            for ty in range(ymin, ymax + 1):
+                for tx in range(xmin, xmax + 1):
+                    if z == zoom and ulx <= tx <= lrx and uly <= ty <= lry:
+                        continue    # in the view
+                    key = self.cacheKey(z, tx, ty)
+                    if (tx, ty) in stored or tileCache.contains(key) or negativeCache.contains(key):
+                        continue
+                    priority = basePriority + self.tilePriority(zoom, centerTile, z, tx, ty)
+                    tiles.append((self.layerDef.tileUrl(z, tx, ty), z, tx, ty, priority))
+
+        if tiles:
+            self.prefetchRequestSignal.emit(tiles)
+
+    def prefetchRequestSlot(self, tiles):
+        # keep tiles being prefetched, and add new tiles
+        self.prefetchTiles = dict((url, key) for url, key in self.prefetchTiles.items()
+                                  if url in self.downloader.prefetching)
+        priorities = {}
+        for url, zoom, x, y, priority in tiles:
+            self.prefetchTiles[url] = (zoom, x, y)
+            priorities[url] = priority
+        self.downloader.prefetchFiles([tile[0] for tile in tiles], self.plugin.prefetchTilesPerMinute, priorities)
+
+    def prefetchFinishedSlot(self, url):
+        result = self.downloader.prefetchedFiles.pop(url, None)
+        key = self.prefetchTiles.pop(url, None)
+        if result is None or key is None:
+            return
+        self.storeTiles([(url, key[0], key[1], key[2], result.data, result.validity())], buffered=True)
+
+        if not (self.downloader.prefetchQueue or self.downloader.prefetching):
+            self.flushDiskTiles()
+
+    def revalidateRequestSlot(self, tiles):
+        for url, zoom, x, y, etag, lastModified in tiles:
+            self.revalidateTiles[url] = (zoom, x, y)
+        self.downloader.revalidateFiles([(tile[0], tile[4], tile[5]) for tile in tiles])
+
+    def revalidateFinishedSlot(self, url):
+        result = self.downloader.revalidatedFiles.pop(url, None)
+        key = self.revalidateTiles.pop(url, None)
+        if result is None or key is None:
+            return
+
+        zoom, x, y = key
+        if result.notModified:
+            # only the expiration is updated
+            diskStore = self.diskStore()
+            if diskStore:
+                diskStore.updateExpiration([(zoom, x, y, result.expiration, result.etag, result.lastModified)])
+            return
+
+        if result.data is None:
+            return
+
+        # the tile has been modified or removed. repaint with the new data
+        cacheKey = self.cacheKey(zoom, x, y)
+        self.plugin.tileCache.remove(cacheKey)
+        self.plugin.imageCache.remove(cacheKey)
+        self.plugin.tileDecoder.decode(cacheKey, result.data)
+        self.storeTiles([(url, zoom, x, y, result.data, result.validity())], buffered=True)
+        self.arrivedTileCount += 1
+        if not self.repaintTimer.isActive():
+            self.repaintTimer.start()
+
+    def findCachedImage(self, zoom, x, y):
+        # find an image of the tile in the memory caches. used to fill tiles which are not available
+        key = self.cacheKey(zoom, x, y)
+        image = self.plugin.imageCache.peek(key)
+        if image is None:
+            data = self.plugin.tileCache.peek(key)
+            if data:
+                image = decodeTileImage(data)
+                self.plugin.imageCache.put(key, image)
+        return image
+
+    def diskStore(self):
+        if self.tileSource:
+            return None     # local tiles need no cache
+        return self.plugin.diskCache.store(self.layerDef.serviceUrl)
+
+    def storeToCache(self, files):
+        # keep tile data fetched synchronously in the memory cache and the disk cache
+        # (self.tiles holds the tiles of current draw)
+        fetchedTiles = []
+        for url, data in files.items():
+            tile = self.tiles.tiles.get(url) if self.tiles else None
+            if tile and data is not None:
+                fetchedTiles.append((url, tile.zoom, tile.x, tile.y, data, self.downloader.validities.get(url)))
+        self.storeTiles(fetchedTiles)
+
+    def storeTiles(self, fetchedTiles, buffered=False):
+        """fetchedTiles: a list of (url, zoom, x, y, data, validity). validity is (expiration, etag, lastModified)
+        of the data, or None if unknown. tiles are put into the memory caches at once. if buffered is True,
+        writing to the disk cache is deferred (main thread only)"""
+        tileCache = self.plugin.tileCache
+        negativeCache = self.plugin.negativeCache
+        if buffered:
+            diskTiles, missingTiles = self.unsavedTiles, self.unsavedMissingTiles
+        else:
+            diskTiles, missingTiles = [], []
+        for url, zoom, x, y, data, validity in fetchedTiles:
+            key = self.cacheKey(zoom, x, y)
+            if data:
+                tileCache.put(key, data)
+                if validity is not None:
+                    diskTiles.append((zoom, x, y, data) + tuple(validity))
+            elif data is not None:
+                # empty data means that the tile does not exist
+                expires = negativeCache.put(key)
+                if expires:
+                    missingTiles.append((zoom, x, y, expires))
+
+        if not buffered:
+            self.writeDiskTiles(diskTiles, missingTiles)
+        elif len(diskTiles) + len(missingTiles) >= self.DISK_STORE_TILES:
+            self.flushDiskTiles()
+        elif (diskTiles or missingTiles) and not self.diskStoreTimer.isActive():
+            self.diskStoreTimer.start()
+
+    def flushDiskTiles(self):
+        """write tiles stored with buffered=True to the disk cache (main thread only)"""
+        self.diskStoreTimer.stop()
+        diskTiles, self.unsavedTiles = self.unsavedTiles, []
+        missingTiles, self.unsavedMissingTiles = self.unsavedMissingTiles, []
+        self.writeDiskTiles(diskTiles, missingTiles)
+
+    def writeDiskTiles(self, diskTiles, missingTiles):
+        diskStore = self.diskStore()
+        if diskStore:
+            diskStore.putTiles(diskTiles)
+            diskStore.putMissing(missingTiles)
+
+    def isCanvasRendering(self, renderContext):
+        # the plugin knows whether a render job of the map canvas is running. exports at
+        # the screen dpi (e.g. Save as Image) while the canvas is idle are not regarded as canvas rendering
+        if not self.plugin.canvasRendering:
+            return False
+
+        # paint device for printing has different dpi from map canvas
+        mapSettings = self.iface.mapCanvas().mapSettings() if self.plugin.apiChanged23 else self.iface.mapCanvas().mapRenderer()
+        return renderContext.painter().device().logicalDpiX() == mapSettings.outputDpi()
+
+    def progressiveReplyFinished(self, url):
+        # the tile has been stored in the caches by the callback of the fetch batch
+        if url not in self.downloader.fetchedFiles or self.pendingTiles.pop(url, None) is None:
+            return      # not requested by progressive rendering, or redirected
+
+        if self.downloader.fetchedFiles[url] is None:
+            return
+        self.arrivedTileCount += 1
+
+        # repaint every PROGRESSIVE_REPAINT_TILES tiles or PROGRESSIVE_REPAINT_INTERVAL ms
+        if self.arrivedTileCount >= self.PROGRESSIVE_REPAINT_TILES:
+            self.progressiveRepaint()
+        elif not self.repaintTimer.isActive():
+            self.repaintTimer.start()
+
+    def progressiveRepaint(self):
+        self.repaintTimer.stop()
+        if not self.arrivedTileCount:
+            return
+        self.arrivedTileCount = 0
+        self.repaintRequested.emit()
+
+    def createFetchBatch(self, urls, priorities=None):
+        # tiles are stored in the caches and decoded in the thread pool as soon as they arrive
+        # (self.tiles holds the tiles of current draw)
+        batch = FetchBatch(urls, priorities, self.plugin.downloadTimeout)
+        tiles = self.tiles
+        if tiles:
+            batch.addCallback(lambda url, data, validity: self.tileArrived(tiles, url, data, validity))
+        return batch
+
+    def tileArrived(self, tiles, url, data, validity):
+        tile = tiles.tiles.get(url)
+        if tile is None or data is None:
+            return
+        self.storeTiles([(url, tile.zoom, tile.x, tile.y, data, validity)], buffered=True)
+        if data and self.plugin.tileDecoder.isEnabled():
+            self.plugin.tileDecoder.decode(self.cacheKey(tile.zoom, tile.x, tile.y), data)
+
+    def decodeTiles(self, tiles):
+        """decode tile data in the thread pool of the plugin and wait for the images.
+        tiles which are not decoded here are decoded in the render thread when they are drawn"""
+        decoder = self.plugin.tileDecoder
+        if not decoder.isEnabled():
+            return
+        waiting = []
+        for tile in tiles.tiles.values():
+            if tile.image is None and tile.data:
+                key = self.cacheKey(tile.zoom, tile.x, tile.y)
+                decoder.decode(key, tile.data)
+                waiting.append((tile, key))
+
+        for tile, key in waiting:
+            tile.image = decoder.image(key)
+
+    def storeImagesToCache(self, tiles):
+        imageCache = self.plugin.imageCache
+        for tile in tiles.tiles.values():
+            if tile.decoded:
+                imageCache.put(self.cacheKey(tile.zoom, tile.x, tile.y), tile.image)
+                tile.decoded = False
+
     # functions for multi-thread rendering
-    def fetchFiles(self, urls):
+    def fetchFiles(self, urls, priorities=None):
         if not self.plugin.apiChanged23:
-            return self.downloader.fetchFiles(urls, self.plugin.downloadTimeout)
+            files = self.downloader.fetchFiles(urls, self.plugin.downloadTimeout, priorities)
+            self.storeToCache(files)
+            return files
 
         self.logT("TileLayer.fetchFiles() starts")
-        # create a QEventLoop object that belongs to the current worker thread
+        # create a QEventLoop object that belongs to the current worker thread.
+        # it quits as soon as the batch has finished
         eventLoop = QEventLoop()
-        self.downloader.allRepliesFinished.connect(eventLoop.quit)
+        batch = self.createFetchBatch(urls, priorities)
+        batch.finished.connect(eventLoop.quit)
 
-        # create a timer to watch whether rendering is stopped
+        # the loop also wakes up periodically to check whether rendering has been stopped. there is
+        # no signal for it: QgsRenderContext only has the renderingStopped() flag, and the main thread
+        # which sets it blocks until this thread returns, so it cannot notify this thread
         watchTimer = QTimer()
         watchTimer.timeout.connect(eventLoop.quit)
 
         # send a fetch request to the main thread
-        self.fetchRequestSignal.emit(urls)
-
-        # wait for the fetch to finish
-        tick = 0
-        interval = 500
-        timeoutTick = self.plugin.downloadTimeout * 1000 / interval
-        watchTimer.start(interval)
-        while tick < timeoutTick:
-            # run event loop for 0.5 seconds at maximum
-            eventLoop.exec_()
-            if self.downloader.unfinishedCount() == 0 or self.renderContext.renderingStopped():
+        self.fetchRequestSignal.emit(batch)
+
+        # wait for the batch to finish
+        deadline = time.time() + self.plugin.downloadTimeout
+        watchTimer.start(self.RENDERING_STOPPED_CHECK_INTERVAL)
+        while not batch.isFinished():
+            if self.renderContext.renderingStopped():
+                # requests in progress are kept for a grace period, so that the next render job can adopt them
+                batch.cancel()
                 break
-            tick += 1
+            if time.time() >= deadline:
+                self.log("fetchFiles timeout")
+                batch.cancel()
+                self.downloader.errorStatus = Downloader.TIMEOUT_ERROR
+                break
+            eventLoop.exec_()
         watchTimer.stop()
+        files = dict(batch.files)
 
-        if tick == timeoutTick and self.downloader.unfinishedCount() > 0:
-            self.log("fetchFiles timeout")
-            self.downloader.abort()
-            self.downloader.errorStatus = Downloader.TIMEOUT_ERROR
-        files = self.downloader.fetchedFiles
-
-        watchTimer.timeout.disconnect(eventLoop.quit)  #
-        self.downloader.allRepliesFinished.disconnect(eventLoop.quit)
+        watchTimer.timeout.disconnect(eventLoop.quit)
+        batch.finished.disconnect(eventLoop.quit)
 
+        # fetched tiles have been stored in the caches in the main thread
         self.logT("TileLayer.fetchFiles() ends")
         return files
 
-    def fetchRequestSlot(self, urls):
-        self.downloader.fetchFilesAsync(urls, self.plugin.downloadTimeout)
+    def fetchRequestSlot(self, batch):
+        self.downloader.fetchBatch(batch)
+
+    def progressiveRequestSlot(self, batch, pendingTiles):
+        # pendingTiles is updated only in the main thread, where the replies arrive
+        self.pendingTiles = dict((url, key) for url, key in self.pendingTiles.iteritems()
+                                 if self.downloader.isPending(url))
+        self.pendingTiles.update(pendingTiles)
+        self.downloader.fetchBatch(batch)
 
     def showStatusMessage(self, msg, timeout=0):
         self.statusSignal.emit(msg, timeout)
@@ -688,6 +1389,7 @@ class TileLayerType(QgsPluginLayerType):
         layer.setTransparency(dialog.ui.spinBox_Transparency.value())
         layer.setBlendModeByName(dialog.ui.comboBox_BlendingMode.currentText())
         layer.setSmoothRender(dialog.ui.checkBox_SmoothRender.isChecked())
+        layer.setOversampling(TileLayerDefinition.OVERSAMPLING_VALUES[dialog.ui.comboBox_Oversampling.currentIndex()])
         layer.setCreditVisibility(dialog.ui.checkBox_CreditVisibility.isChecked())
         layer.repaintRequested.emit()
 
@@ -700,6 +1402,13 @@ class HonestAccess:
             return 2  # http://wiki.openstreetmap.org/wiki/Tile_usage_policy
         return 6
 
+    @staticmethod
+    def prefetchAllowed(url):
+        host = QUrl(url).host()
+        if "openstreetmap.org" in host:  # bulk downloading is prohibited by the tile usage policy
+            return False
+        return True
+
     @staticmethod
     def restrictedByTOS(url):
         # whether access to the url is restricted by TOS
@@ -21,12 +21,18 @@
 """
 import os
 
-from PyQt4.QtCore import Qt, QCoreApplication, QFile, QObject, QSettings, QTranslator, qVersion, qDebug
+from PyQt4.QtCore import Qt, QCoreApplication, QFile, QObject, QSettings, QThread, QTranslator, qVersion, qDebug
 from PyQt4.QtGui import QAction, QIcon
-from qgis.core import QGis, QgsCoordinateReferenceSystem, QgsMapLayerRegistry, QgsPluginLayerRegistry
+from qgis.core import QGis, QgsApplication, QgsCoordinateReferenceSystem, QgsMapLayerRegistry, QgsPluginLayerRegistry
 from qgis.gui import QgsMessageBar
 
+from diskcache import DiskCache
+from downloader import DownloadPool
+from reprojection import createWarpEngine
+from tilecache import NegativeCache, TileCache
+from tiledecoder import TileDecoder
 from tilelayer import TileLayer, TileLayerType
+from tiles import transformCache
 #import pydevd
 debug_mode = 0
 
@@ -61,12 +67,71 @@ class TileLayerPlugin:
         self.crs3857 = None
         self.layers = {}
 
+        # coordinate transforms shared by all tile layers
+        self.transformCache = transformCache
+
+        # in-memory tile caches shared by all tile layers
+        memoryCacheSize = int(settings.value("/TileLayerPlugin/memoryCacheSize", 64, type=int))   # MB
+        self.tileCache = TileCache(memoryCacheSize * 1024 * 1024)
+        imageCacheSize = int(settings.value("/TileLayerPlugin/imageCacheSize", 128, type=int))    # MB, 0 to disable
+        self.imageCache = TileCache(imageCacheSize * 1024 * 1024, lambda image: image.byteCount())
+
+        # thread pool which decodes tile images into the image cache
+        decodeThreads = int(settings.value("/TileLayerPlugin/decodeThreads", QThread.idealThreadCount(), type=int))   # 0 to disable
+        self.tileDecoder = TileDecoder(self.imageCache, decodeThreads)
+
+        # persistent tile cache
+        diskCacheDir = settings.value("/TileLayerPlugin/diskCacheDir", "", type=unicode)
+        if not diskCacheDir:
+            diskCacheDir = os.path.join(QgsApplication.qgisSettingsDirPath(), "TileLayerPlugin", "cache")
+        diskCacheSize = int(settings.value("/TileLayerPlugin/diskCacheSize", 256, type=int))    # MB per layer, 0 to disable
+        self.diskCache = DiskCache(diskCacheDir, diskCacheSize * 1024 * 1024)
+
+        # tiles which do not exist on the server
+        negativeCacheTTL = int(settings.value("/TileLayerPlugin/negativeCacheTTL", 60, type=int))    # minutes, 0 to disable
+        self.negativeCache = NegativeCache(negativeCacheTTL * 60)
+
+        # download pool which limits connections per host over all tile layers
+        cacheExpiry = settings.value("/qgis/defaultTileExpiry", 24, type=int)
+        userAgent = "QGIS/{0} TileLayerPlugin/{1}".format(QGis.QGIS_VERSION, self.VERSION)  # will be overwritten in QgsNetworkAccessManager::createRequest() since 2.2
+        maxRetries = int(settings.value("/TileLayerPlugin/maxRetries", 3, type=int))
+        self.downloadPool = DownloadPool(None, cacheExpiry, userAgent, maxRetries)
+
+        # reprojection of tiles (None if neither python-gdal nor numpy is available).
+        # these options are not in the settings dialog
+        self.warpEngine = createWarpEngine(settings.value("/TileLayerPlugin/warpResampling", "bilinear", type=unicode),
+                                           float(settings.value("/TileLayerPlugin/warpErrorThreshold", 0.125, type=float)),   # pixels
+                                           int(settings.value("/TileLayerPlugin/warpThreads", 0, type=int)),        # 0: all CPUs
+                                           int(settings.value("/TileLayerPlugin/warpMemoryLimit", 64, type=int)))   # MB
+
+        # reprojected chunks of tiles, reused in following repaints of the map canvas
+        reprojectionCacheSize = int(settings.value("/TileLayerPlugin/reprojectionCacheSize", 64, type=int))   # MB, 0 to disable
+        self.reprojectionCache = TileCache(reprojectionCacheSize * 1024 * 1024, lambda chunk: chunk[1].byteCount())
+
+        # fallback for tiles that are loading or failed to load
+        self.maxAncestorDistance = int(settings.value("/TileLayerPlugin/maxAncestorDistance", 4, type=int))
+        self.fallbackToChildren = int(settings.value("/TileLayerPlugin/fallbackToChildren", Qt.Checked, type=int))
+        self.progressiveRendering = int(settings.value("/TileLayerPlugin/progressiveRendering", Qt.Unchecked, type=int))
+        self.prefetchTilesPerMinute = int(settings.value("/TileLayerPlugin/prefetchTilesPerMinute", 120, type=int))
+        self.drawMethod = int(settings.value("/TileLayerPlugin/drawMethod", TileLayer.DRAW_AUTO, type=int))
+        self.zoomPolicy = int(settings.value("/TileLayerPlugin/zoomPolicy", TileLayer.ZOOM_CEIL, type=int))
+        self.dpiAwareZoom = int(settings.value("/TileLayerPlugin/dpiAwareZoom", Qt.Unchecked, type=int))
+
         # register plugin layer type
         self.tileLayerType = TileLayerType(self)
         QgsPluginLayerRegistry.instance().addPluginLayerType(self.tileLayerType)
 
+        # whether the map canvas is rendering. without renderStarting signal (QGIS < 2.4),
+        # rendering at the canvas dpi is regarded as canvas rendering
+        mapCanvas = iface.mapCanvas()
+        self.canvasRenderSignals = hasattr(mapCanvas, "renderStarting")
+        self.canvasRendering = not self.canvasRenderSignals
+
         # connect signal-slot
         QgsMapLayerRegistry.instance().layerRemoved.connect(self.layerRemoved)
+        if self.canvasRenderSignals:
+            mapCanvas.renderStarting.connect(self.canvasRenderStarting)
+            mapCanvas.mapCanvasRefreshed.connect(self.canvasRefreshed)
 
     def initGui(self):
         # create action
@@ -97,10 +162,45 @@ class TileLayerPlugin:
 
         # disconnect signal-slot
         QgsMapLayerRegistry.instance().layerRemoved.disconnect(self.layerRemoved)
+        if self.canvasRenderSignals:
+            mapCanvas = self.iface.mapCanvas()
+            mapCanvas.renderStarting.disconnect(self.canvasRenderStarting)
+            mapCanvas.mapCanvasRefreshed.disconnect(self.canvasRefreshed)
+
+        # abort requests in progress
+        self.downloadPool.abortAll()
+        self.tileDecoder.waitForDone()
+
+        # release cached tiles
+        for layer in self.layers.values():
+            layer.flushDiskTiles()
+        self.tileCache.clear()
+        self.imageCache.clear()
+        self.reprojectionCache.clear()
+        self.negativeCache.clear()
+        self.diskCache.close()
+        if self.warpEngine:
+            self.warpEngine.clear()
+        self.transformCache.clear()
+
+    def canvasRenderStarting(self):
+        self.canvasRendering = True
+
+    def canvasRefreshed(self):
+        self.canvasRendering = False
 
     def layerRemoved(self, layerId):
       if layerId in self.layers:
-        del self.layers[layerId]
+        layer = self.layers.pop(layerId)
+        layer.flushDiskTiles()
+        layer.closeTileSource()
+        layer.downloader.release()
+
+        # release cached tiles of the service unless another layer uses it
+        serviceUrl = layer.layerDef.serviceUrl
+        if all(l.layerDef.serviceUrl != serviceUrl for l in self.layers.values()):
+          for cache in [self.tileCache, self.imageCache, self.reprojectionCache, self.negativeCache]:
+            cache.removeLayer(serviceUrl)
         if debug_mode:
           qDebug("Layer %s removed" % layerId.encode("UTF-8"))
 
@@ -140,6 +240,19 @@ class TileLayerPlugin:
       if not accepted:
         return False
       self.downloadTimeout = dialog.ui.spinBox_downloadTimeout.value()
+      self.tileCache.setMaxBytes(dialog.ui.spinBox_memoryCacheSize.value() * 1024 * 1024)
+      self.imageCache.setMaxBytes(dialog.ui.spinBox_imageCacheSize.value() * 1024 * 1024)
+      self.diskCache.setMaxBytesPerStore(dialog.ui.spinBox_diskCacheSize.value() * 1024 * 1024)
+      self.tileDecoder.setMaxThreadCount(dialog.ui.spinBox_decodeThreads.value())
+      self.negativeCache.setTtl(dialog.ui.spinBox_negativeCacheTTL.value() * 60)
+      self.maxAncestorDistance = dialog.ui.spinBox_maxAncestorDistance.value()
+      self.fallbackToChildren = dialog.ui.checkBox_FallbackToChildren.checkState()
+      self.progressiveRendering = dialog.ui.checkBox_ProgressiveRendering.checkState()
+      self.prefetchTilesPerMinute = dialog.ui.spinBox_prefetchTilesPerMinute.value()
+      self.downloadPool.maxRetries = dialog.ui.spinBox_maxRetries.value()
+      self.drawMethod = dialog.ui.comboBox_drawMethod.currentIndex()
+      self.zoomPolicy = dialog.ui.comboBox_zoomPolicy.currentIndex()
+      self.dpiAwareZoom = dialog.ui.checkBox_DpiAwareZoom.checkState()
       self.navigationMessagesEnabled = dialog.ui.checkBox_NavigationMessages.checkState()
 
       moveToLayer = dialog.ui.checkBox_MoveToLayer.checkState()
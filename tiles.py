@@ -20,7 +20,8 @@
  ***************************************************************************/
 """
 import math
-from PyQt4.QtCore import QRect, Qt
+import threading
+from PyQt4.QtCore import QRect, QRectF, Qt
 from PyQt4.QtGui import QImage, QPainter
 from qgis.core import *
 
@@ -32,6 +33,11 @@ class TileDefaultSettings:
     ZMAX = 18
 
 
+def urlScheme(url):
+    # schemes are case-insensitive
+    return url.split(":", 1)[0].lower() if ":" in url else ""
+
+
 def degreesToMercatorMeters(lon, lat):
     # formula: http://en.wikipedia.org/wiki/Mercator_projection#Mathematics_of_the_Mercator_projection
     x = R * lon * math.pi / 180
@@ -39,6 +45,43 @@ def degreesToMercatorMeters(lon, lat):
     return x, y
 
 
+def crsKey(crs):
+    # custom CRSs which have not been saved have srsid 0, so they are identified by the definition
+    return crs.srsid() or crs.toProj4()
+
+
+class TransformCache:
+    """coordinate reference systems and transforms shared by the plugin. they are cached for each thread
+    because a coordinate transform cannot be used by multiple threads at the same time"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def crs(self, epsg):
+        crss = self._local.__dict__.setdefault("crss", {})
+        if epsg not in crss:
+            crss[epsg] = QgsCoordinateReferenceSystem(epsg, QgsCoordinateReferenceSystem.PostgisCrsId)
+        return crss[epsg]
+
+    def transform(self, sourceCrs, destCrs):
+        """sourceCrs, destCrs: QgsCoordinateReferenceSystem objects or EPSG codes"""
+        if not isinstance(sourceCrs, QgsCoordinateReferenceSystem):
+            sourceCrs = self.crs(sourceCrs)
+        if not isinstance(destCrs, QgsCoordinateReferenceSystem):
+            destCrs = self.crs(destCrs)
+        transforms = self._local.__dict__.setdefault("transforms", {})
+        key = (crsKey(sourceCrs), crsKey(destCrs))
+        if key not in transforms:
+            transforms[key] = QgsCoordinateTransform(sourceCrs, destCrs)
+        return transforms[key]
+
+    def clear(self):
+        self._local = threading.local()
+
+
+transformCache = TransformCache()
+
+
 class BoundingBox:
     def __init__(self, xmin, ymin, xmax, ymax):
         self.xmin = xmin
@@ -68,9 +111,7 @@ class BoundingBox:
 
     @classmethod
     def epsgToMercatorMeters(cls, bbox, epsg):
-        src = QgsCoordinateReferenceSystem(epsg, QgsCoordinateReferenceSystem.PostgisCrsId)
-        dest = QgsCoordinateReferenceSystem(3857, QgsCoordinateReferenceSystem.PostgisCrsId)
-        xfrm = QgsCoordinateTransform(src, dest)
+        xfrm = transformCache.transform(epsg, 3857)
 
         rect = bbox.toQgsRectangle()
         dr = xfrm.transform(rect)
@@ -90,8 +131,13 @@ class TileLayerDefinition:
     TILE_SIZE = 256
     TSIZE1 = 20037508.342789244
 
+    # oversampling of reprojection. adaptive uses low resolution while the map is being navigated,
+    # and high resolution when the map is idle or printed
+    OVERSAMPLING_ADAPTIVE = 0
+    OVERSAMPLING_VALUES = [1, 1.5, 2, OVERSAMPLING_ADAPTIVE]
+
     def __init__(self, title, attribution, serviceUrl, yOriginTop=1, zmin=TileDefaultSettings.ZMIN,
-                 zmax=TileDefaultSettings.ZMAX, bbox=None, epsg=None):
+                 zmax=TileDefaultSettings.ZMAX, bbox=None, epsg=None, oversampling=None):
         self.title = title
         self.attribution = attribution
         self.serviceUrl = serviceUrl
@@ -100,8 +146,13 @@ class TileLayerDefinition:
         self.zmax = zmax
         self.bbox = bbox
         self.epsg = epsg
+        self.oversampling = oversampling    # None for the default of the layer
+        self._bboxCache = None              # (bbox and epsg, bbox in EPSG:3857, {zoom: tile range})
 
     def tileUrl(self, zoom, x, y):
+        if urlScheme(self.serviceUrl) == "mbtiles":
+            # tiles are in a single file. the url is used only to identify a tile
+            return "%s?z=%d&x=%d&y=%d" % (self.serviceUrl, zoom, x, y)
         if not self.yOriginTop:
             y = (2 ** zoom - 1) - y
         return self.serviceUrl.replace("{z}", str(zoom)).replace("{x}", str(x)).replace("{y}", str(y))
@@ -111,12 +162,6 @@ class TileLayerDefinition:
         return QgsRectangle(x * size - self.TSIZE1, self.TSIZE1 - y * size, (x + 1) * size - self.TSIZE1,
                             self.TSIZE1 - (y + 1) * size)
 
-    def epsgToTileRange(self, zoom, bbox):
-        mercatbbox = BoundingBox.epsgToMercatorMeters(bbox, self.epsg)
-        xmin, ymin = self.coordsToTile(zoom, mercatbbox.xmin, mercatbbox.ymax)
-        xmax, ymax = self.coordsToTile(zoom, mercatbbox.xmax, mercatbbox.ymin)
-        return BoundingBox(xmin, ymin, xmax, ymax)
-
     def coordsToTile(self, zoom, x, y):
         size = self.TSIZE1 / 2 ** (zoom - 1)
         tx = int((x + self.TSIZE1) / size)
@@ -128,6 +173,46 @@ class TileLayerDefinition:
         xmax, ymax = self.coordsToTile(zoom, bbox.xmax, bbox.ymin)
         return BoundingBox(xmin, ymin, xmax, ymax)
 
+    def mercatorBBox(self):
+        """returns the bounding box in EPSG:3857, or None if the layer has no bounding box"""
+        if not self.bbox:
+            return None
+        return self._bboxCacheEntry()[1]
+
+    def bboxTileRange(self, zoom):
+        """returns the tile range of the bounding box at the zoom level"""
+        _, mercatorBBox, ranges = self._bboxCacheEntry()
+        if zoom not in ranges:
+            ranges[zoom] = self.bboxMercatorToTileRange(zoom, mercatorBBox)
+        return ranges[zoom]
+
+    def _bboxCacheEntry(self):
+        # computed again when bbox or epsg has been changed
+        bbox = self.bbox
+        key = (bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax, self.epsg)
+        entry = self._bboxCache
+        if entry is None or entry[0] != key:
+            if self.epsg == 3857 or self.epsg == 900913:
+                mercatorBBox = BoundingBox(bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax)
+            else:
+                mercatorBBox = BoundingBox.epsgToMercatorMeters(bbox, self.epsg or 4326)
+            entry = self._bboxCache = (key, mercatorBBox, {})
+        return entry
+
+    @classmethod
+    def parseOversampling(cls, text):
+        """text: "1", "1.5", "2" or "adaptive". raises ValueError for other values"""
+        if text.strip().lower() == "adaptive":
+            return cls.OVERSAMPLING_ADAPTIVE
+        value = float(text)
+        if value == cls.OVERSAMPLING_ADAPTIVE or value not in cls.OVERSAMPLING_VALUES:
+            raise ValueError("invalid oversampling: %s" % text)
+        return value
+
+    @classmethod
+    def oversamplingToString(cls, value):
+        return "adaptive" if value == cls.OVERSAMPLING_ADAPTIVE else "%g" % value
+
     def __str__(self):
         return "%s (%s)" % (self.title, self.serviceUrl)
 
@@ -143,12 +228,33 @@ class TileLayerDefinition:
         return TileLayerDefinition("", "", "")
 
 
+def decodeTileImage(data):
+    """decode tile data into a premultiplied ARGB32 image. returns None if the data cannot be decoded"""
+    image = QImage()
+    if not data or not image.loadFromData(data):
+        return None
+    if image.format() != QImage.Format_ARGB32_Premultiplied:
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+    return image
+
+
 class Tile:
-    def __init__(self, zoom, x, y, data=None):
+    def __init__(self, zoom, x, y, data=None, image=None):
         self.zoom = zoom
         self.x = x
         self.y = y
         self.data = data
+        self.image = image      # decoded image
+        self.decoded = False    # whether the image has been decoded from data in this draw
+
+    def hasImage(self):
+        return self.image is not None or bool(self.data)
+
+    def toImage(self):
+        if self.image is None and self.data:
+            self.image = decodeTileImage(self.data)
+            self.decoded = self.image is not None
+        return self.image
 
 
 class Tiles:
@@ -164,6 +270,16 @@ class Tiles:
         self.serviceInfo = serviceInfo
         self.tiles = {}
 
+        # fallback for tiles that are loading or failed to load
+        self.findImage = None     # function that returns a cached image of a tile: findImage(zoom, x, y)
+        self.maxAncestorDistance = 0
+        self.fallbackToChildren = False
+
+    def setFallback(self, findImage, maxAncestorDistance, fallbackToChildren=True):
+        self.findImage = findImage
+        self.maxAncestorDistance = maxAncestorDistance
+        self.fallbackToChildren = fallbackToChildren
+
     def addTile(self, url, tile):
         self.tiles[url] = tile
 
@@ -171,26 +287,138 @@ class Tiles:
         if url in self.tiles:
             self.tiles[url].data = data
 
-    def image(self):
+    def image(self, mosaic=None):
+        """returns an image of the tiles. if mosaic is given, it is updated and its image is returned"""
+        if mosaic:
+            return mosaic.update(self)
+
         width = (self.xmax - self.xmin + 1) * self.TILE_SIZE
         height = (self.ymax - self.ymin + 1) * self.TILE_SIZE
         image = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
         image.fill(Qt.transparent)
         p = QPainter(image)
+        p.setRenderHint(QPainter.SmoothPixmapTransform)
         for tile in self.tiles.values():
-            if not tile.data:
-                continue
-
             x = tile.x - self.xmin
             y = tile.y - self.ymin
             rect = QRect(x * self.TILE_SIZE, y * self.TILE_SIZE, self.TILE_SIZE, self.TILE_SIZE)
 
-            timg = QImage()
-            timg.loadFromData(tile.data)
-            p.drawImage(rect, timg)
+            timg = tile.toImage()
+            if timg is not None:
+                p.drawImage(rect, timg)
+            elif tile.data is None and self.findImage:
+                # tile is still loading or failed to load
+                self.drawFallback(p, rect, tile)
         return image
 
+    def drawFallback(self, p, rect, tile):
+        """fill the tile rect with the nearest cached ancestor tile (upscaled) and cached children (downsampled)"""
+        drawn = False
+        for d in range(1, self.maxAncestorDistance + 1):
+            zoom = tile.zoom - d
+            if zoom < 0:
+                break
+            ax, ay = tile.x >> d, tile.y >> d
+            aimg = self.findImage(zoom, ax, ay)
+            if aimg is not None:
+                n = 2 ** d
+                size = float(aimg.width()) / n
+                source = QRectF((tile.x - ax * n) * size, (tile.y - ay * n) * size, size, size)
+                p.drawImage(QRectF(rect), aimg, source)
+                drawn = True
+                break
+
+        if self.fallbackToChildren:
+            half = rect.width() / 2
+            for cy in range(2):
+                for cx in range(2):
+                    cimg = self.findImage(tile.zoom + 1, 2 * tile.x + cx, 2 * tile.y + cy)
+                    if cimg is not None:
+                        p.drawImage(QRect(rect.x() + cx * half, rect.y() + cy * half, half, half), cimg)
+                        drawn = True
+        return drawn
+
     def extent(self):
         size = self.TSIZE1 / 2 ** (self.zoom - 1)
         return QgsRectangle(self.xmin * size - self.TSIZE1, self.TSIZE1 - (self.ymax + 1) * size,
                             (self.xmax + 1) * size - self.TSIZE1, self.TSIZE1 - self.ymin * size)
+
+
+class Mosaic:
+    """Image of the tiles of a layer that is kept between draws. If the tile range of the next draw
+    overlaps the previous one, the overlapping part is reused (shifted if the range has moved), and
+    only tiles whose images have changed are painted. Acquire lock while using the image."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.image = None
+        self._spare = None      # buffer of the same size as the image, into which the image is shifted
+        self.zoom = None
+        self.xmin = self.ymin = self.xmax = self.ymax = None
+
+        # (x, y): cache key of the tile image painted there, or 0 for a transparent tile.
+        # tiles painted with fallback images are not included so that they are painted again
+        self.painted = {}
+
+    def update(self, tiles):
+        """paints changed tiles into the mosaic and returns the image of the tiles"""
+        size = tiles.TILE_SIZE
+        width = (tiles.xmax - tiles.xmin + 1) * size
+        height = (tiles.ymax - tiles.ymin + 1) * size
+
+        image = self.image
+        if image is None or image.width() != width or image.height() != height:
+            target = QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+            self._spare = None
+        elif tiles.zoom != self.zoom or tiles.xmin != self.xmin or tiles.ymin != self.ymin:
+            target = self._spare if self._spare is not None else QImage(width, height, QImage.Format_ARGB32_Premultiplied)
+            self._spare = image
+        else:
+            target = image
+
+        p = QPainter(target)
+        p.setCompositionMode(QPainter.CompositionMode_Source)
+        if target is not image:
+            target.fill(Qt.transparent)
+            painted = {}
+            if image is not None and tiles.zoom == self.zoom:
+                # reuse the overlapping part of the previous range
+                p.drawImage((self.xmin - tiles.xmin) * size, (self.ymin - tiles.ymin) * size, image)
+                painted = dict(((x, y), key) for (x, y), key in self.painted.iteritems()
+                               if tiles.xmin <= x <= tiles.xmax and tiles.ymin <= y <= tiles.ymax)
+            self.painted = painted
+            self.image = target
+            self.zoom, self.xmin, self.ymin, self.xmax, self.ymax = tiles.zoom, tiles.xmin, tiles.ymin, tiles.xmax, tiles.ymax
+
+        p.setRenderHint(QPainter.SmoothPixmapTransform)
+        painted = self.painted
+        for tile in tiles.tiles.values():
+            pos = (tile.x, tile.y)
+            timg = tile.toImage()
+            if timg is not None:
+                key = timg.cacheKey()
+            else:
+                key = None if tile.data is None else 0      # loading, or not found
+            if key is not None and painted.get(pos) == key:
+                continue
+
+            rect = QRect((tile.x - tiles.xmin) * size, (tile.y - tiles.ymin) * size, size, size)
+            if timg is not None:
+                p.drawImage(rect, timg)
+            else:
+                p.fillRect(rect, Qt.transparent)
+                if key is None and tiles.findImage:
+                    # tile is still loading or failed to load
+                    p.setCompositionMode(QPainter.CompositionMode_SourceOver)
+                    tiles.drawFallback(p, rect, tile)
+                    p.setCompositionMode(QPainter.CompositionMode_Source)
+
+            if key is None:
+                painted.pop(pos, None)
+            else:
+                painted[pos] = key
+        p.end()
+        return target
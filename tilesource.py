@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ TileSource
+   tile sources which read tiles directly without the network stack
+                              -------------------
+        begin                : 2012-12-16
+        copyright            : (C) 2013 by Minoru Akagi
+        email                : akaginch@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import sqlite3
+import threading
+from PyQt4.QtCore import QByteArray, QUrl, qDebug
+from tiles import urlScheme
+
+
+class TileSource:
+    """Base class of tile sources. A tile source reads tiles in a tile range at once.
+    Tiles of services that have no tile source are downloaded with Downloader."""
+
+    def __init__(self, layerDef):
+        self.layerDef = layerDef
+
+    def readTiles(self, zoom, xmin, ymin, xmax, ymax, tiles=None):
+        """returns a dict of tile data: {(x, y): QByteArray}. data of absent tiles is an empty QByteArray.
+        if tiles (a collection of (x, y)) is given, only the tiles are read. returns None if the source
+        cannot be read at the moment (e.g. the file is locked)."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def tilesInRange(xmin, ymin, xmax, ymax, tiles=None):
+        if tiles is not None:
+            return list(tiles)
+        return [(x, y) for y in range(ymin, ymax + 1) for x in range(xmin, xmax + 1)]
+
+
+class MBTilesSource(TileSource):
+    """Reads tiles from a MBTiles file. url format: mbtiles:///path/to/file.mbtiles"""
+
+    def __init__(self, layerDef):
+        TileSource.__init__(self, layerDef)
+        self.filename = QUrl(layerDef.serviceUrl).path()
+        if len(self.filename) > 2 and self.filename[0] == "/" and self.filename[2] == ":":
+            self.filename = self.filename[1:]     # /d:/path/to/file.mbtiles on Windows
+        self._lock = threading.Lock()
+        self.db = None
+
+    def readTiles(self, zoom, xmin, ymin, xmax, ymax, tiles=None):
+        result = dict((key, QByteArray()) for key in self.tilesInRange(xmin, ymin, xmax, ymax, tiles))
+
+        # tile_row of MBTiles is in the TMS scheme (origin is bottom-left)
+        flip = 2 ** zoom - 1
+        with self._lock:
+            try:
+                if self.db is None:
+                    self.db = sqlite3.connect(self.filename, check_same_thread=False)
+                rows = self.db.execute("SELECT tile_column, tile_row, tile_data FROM tiles WHERE zoom_level=? AND "
+                                       "tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?",
+                                       (zoom, xmin, xmax, flip - ymax, flip - ymin)).fetchall()
+            except sqlite3.Error as e:
+                qDebug("Failed to read tiles from %s: %s" % (self.filename, str(e)))
+                # the file is opened again in the next read
+                if self.db:
+                    self.db.close()
+                    self.db = None
+                return None
+
+        for x, row, data in rows:
+            key = (x, flip - row)
+            if key in result:
+                result[key] = QByteArray(str(data))
+        return result
+
+    def close(self):
+        with self._lock:
+            if self.db:
+                self.db.close()
+                self.db = None
+
+
+class DirectoryTileSource(TileSource):
+    """Reads tiles from a tile pyramid in a local directory. url format: file:///path/to/tiles/{z}/{x}/{y}.png"""
+
+    def readTiles(self, zoom, xmin, ymin, xmax, ymax, tiles=None):
+        result = {}
+        for x, y in self.tilesInRange(xmin, ymin, xmax, ymax, tiles):
+            filename = QUrl(self.layerDef.tileUrl(zoom, x, y)).toLocalFile()
+            try:
+                with open(filename, "rb") as f:
+                    result[(x, y)] = QByteArray(f.read())
+            except IOError:
+                result[(x, y)] = QByteArray()
+        return result
+
+
+# tile source classes by url scheme
+tileSourceClasses = {"mbtiles": MBTilesSource,
+                     "file": DirectoryTileSource}
+
+
+def registerTileSource(scheme, cls):
+    tileSourceClasses[scheme.lower()] = cls
+
+
+def createTileSource(layerDef):
+    """returns a tile source for the layer definition, or None if tiles should be downloaded"""
+    url = layerDef.serviceUrl
+    if not url or url[0] == ":":
+        return None
+    cls = tileSourceClasses.get(urlScheme(url))
+    return cls(layerDef) if cls else None
@@ -26,7 +26,7 @@ except AttributeError:
 class Ui_Dialog(object):
     def setupUi(self, Dialog):
         Dialog.setObjectName(_fromUtf8("Dialog"))
-        Dialog.resize(438, 367)
+        Dialog.resize(438, 393)
         self.gridLayout = QtGui.QGridLayout(Dialog)
         self.gridLayout.setObjectName(_fromUtf8("gridLayout"))
         self.gridLayout_2 = QtGui.QGridLayout()
@@ -76,6 +76,16 @@ class Ui_Dialog(object):
         self.label_3.setObjectName(_fromUtf8("label_3"))
         self.horizontalLayout.addWidget(self.label_3)
         self.formLayout.setLayout(2, QtGui.QFormLayout.FieldRole, self.horizontalLayout)
+        self.label_4 = QtGui.QLabel(self.groupBox_Style)
+        self.label_4.setObjectName(_fromUtf8("label_4"))
+        self.formLayout.setWidget(3, QtGui.QFormLayout.LabelRole, self.label_4)
+        self.comboBox_Oversampling = QtGui.QComboBox(self.groupBox_Style)
+        self.comboBox_Oversampling.setObjectName(_fromUtf8("comboBox_Oversampling"))
+        self.comboBox_Oversampling.addItem(_fromUtf8(""))
+        self.comboBox_Oversampling.addItem(_fromUtf8(""))
+        self.comboBox_Oversampling.addItem(_fromUtf8(""))
+        self.comboBox_Oversampling.addItem(_fromUtf8(""))
+        self.formLayout.setWidget(3, QtGui.QFormLayout.FieldRole, self.comboBox_Oversampling)
         self.verticalLayout.addLayout(self.formLayout)
         self.checkBox_SmoothRender = QtGui.QCheckBox(self.groupBox_Style)
         self.checkBox_SmoothRender.setObjectName(_fromUtf8("checkBox_SmoothRender"))
@@ -107,6 +117,11 @@ class Ui_Dialog(object):
         self.label.setText(_translate("Dialog", "Transparency", None))
         self.label_2.setText(_translate("Dialog", "Blending mode", None))
         self.label_3.setText(_translate("Dialog", "(Default: SourceOver)", None))
+        self.label_4.setText(_translate("Dialog", "Reprojection quality", None))
+        self.comboBox_Oversampling.setItemText(0, _translate("Dialog", "1x", None))
+        self.comboBox_Oversampling.setItemText(1, _translate("Dialog", "1.5x", None))
+        self.comboBox_Oversampling.setItemText(2, _translate("Dialog", "2x", None))
+        self.comboBox_Oversampling.setItemText(3, _translate("Dialog", "Adaptive (1x while navigating, 2x when idle)", None))
         self.checkBox_SmoothRender.setText(_translate("Dialog", "Smoothing", None))
         self.checkBox_CreditVisibility.setText(_translate("Dialog", "Place the credit on the bottom right corner", None))
         self.groupBox_Properties.setTitle(_translate("Dialog", "Properties", None))
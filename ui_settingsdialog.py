@@ -26,7 +26,7 @@ except AttributeError:
 class Ui_Dialog(object):
     def setupUi(self, Dialog):
         Dialog.setObjectName(_fromUtf8("Dialog"))
-        Dialog.resize(512, 143)
+        Dialog.resize(512, 472)
         self.gridLayout = QtGui.QGridLayout(Dialog)
         self.gridLayout.setObjectName(_fromUtf8("gridLayout"))
         self.verticalLayout = QtGui.QVBoxLayout()
@@ -59,6 +59,137 @@ class Ui_Dialog(object):
         self.spinBox_downloadTimeout.setSingleStep(10)
         self.spinBox_downloadTimeout.setObjectName(_fromUtf8("spinBox_downloadTimeout"))
         self.formLayout.setWidget(1, QtGui.QFormLayout.FieldRole, self.spinBox_downloadTimeout)
+        self.label_3 = QtGui.QLabel(Dialog)
+        self.label_3.setObjectName(_fromUtf8("label_3"))
+        self.formLayout.setWidget(2, QtGui.QFormLayout.LabelRole, self.label_3)
+        self.spinBox_memoryCacheSize = QtGui.QSpinBox(Dialog)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.spinBox_memoryCacheSize.sizePolicy().hasHeightForWidth())
+        self.spinBox_memoryCacheSize.setSizePolicy(sizePolicy)
+        self.spinBox_memoryCacheSize.setMinimumSize(QtCore.QSize(50, 0))
+        self.spinBox_memoryCacheSize.setMaximum(4096)
+        self.spinBox_memoryCacheSize.setSingleStep(16)
+        self.spinBox_memoryCacheSize.setObjectName(_fromUtf8("spinBox_memoryCacheSize"))
+        self.formLayout.setWidget(2, QtGui.QFormLayout.FieldRole, self.spinBox_memoryCacheSize)
+        self.label_4 = QtGui.QLabel(Dialog)
+        self.label_4.setObjectName(_fromUtf8("label_4"))
+        self.formLayout.setWidget(3, QtGui.QFormLayout.LabelRole, self.label_4)
+        self.spinBox_imageCacheSize = QtGui.QSpinBox(Dialog)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.spinBox_imageCacheSize.sizePolicy().hasHeightForWidth())
+        self.spinBox_imageCacheSize.setSizePolicy(sizePolicy)
+        self.spinBox_imageCacheSize.setMinimumSize(QtCore.QSize(50, 0))
+        self.spinBox_imageCacheSize.setMaximum(4096)
+        self.spinBox_imageCacheSize.setSingleStep(16)
+        self.spinBox_imageCacheSize.setObjectName(_fromUtf8("spinBox_imageCacheSize"))
+        self.formLayout.setWidget(3, QtGui.QFormLayout.FieldRole, self.spinBox_imageCacheSize)
+        self.label_5 = QtGui.QLabel(Dialog)
+        self.label_5.setObjectName(_fromUtf8("label_5"))
+        self.formLayout.setWidget(4, QtGui.QFormLayout.LabelRole, self.label_5)
+        self.spinBox_diskCacheSize = QtGui.QSpinBox(Dialog)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.spinBox_diskCacheSize.sizePolicy().hasHeightForWidth())
+        self.spinBox_diskCacheSize.setSizePolicy(sizePolicy)
+        self.spinBox_diskCacheSize.setMinimumSize(QtCore.QSize(50, 0))
+        self.spinBox_diskCacheSize.setMaximum(65536)
+        self.spinBox_diskCacheSize.setSingleStep(64)
+        self.spinBox_diskCacheSize.setObjectName(_fromUtf8("spinBox_diskCacheSize"))
+        self.formLayout.setWidget(4, QtGui.QFormLayout.FieldRole, self.spinBox_diskCacheSize)
+        self.label_6 = QtGui.QLabel(Dialog)
+        self.label_6.setObjectName(_fromUtf8("label_6"))
+        self.formLayout.setWidget(5, QtGui.QFormLayout.LabelRole, self.label_6)
+        self.spinBox_maxAncestorDistance = QtGui.QSpinBox(Dialog)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.spinBox_maxAncestorDistance.sizePolicy().hasHeightForWidth())
+        self.spinBox_maxAncestorDistance.setSizePolicy(sizePolicy)
+        self.spinBox_maxAncestorDistance.setMinimumSize(QtCore.QSize(50, 0))
+        self.spinBox_maxAncestorDistance.setMaximum(10)
+        self.spinBox_maxAncestorDistance.setSingleStep(1)
+        self.spinBox_maxAncestorDistance.setObjectName(_fromUtf8("spinBox_maxAncestorDistance"))
+        self.formLayout.setWidget(5, QtGui.QFormLayout.FieldRole, self.spinBox_maxAncestorDistance)
+        self.label_7 = QtGui.QLabel(Dialog)
+        self.label_7.setObjectName(_fromUtf8("label_7"))
+        self.formLayout.setWidget(6, QtGui.QFormLayout.LabelRole, self.label_7)
+        self.spinBox_prefetchTilesPerMinute = QtGui.QSpinBox(Dialog)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.spinBox_prefetchTilesPerMinute.sizePolicy().hasHeightForWidth())
+        self.spinBox_prefetchTilesPerMinute.setSizePolicy(sizePolicy)
+        self.spinBox_prefetchTilesPerMinute.setMinimumSize(QtCore.QSize(50, 0))
+        self.spinBox_prefetchTilesPerMinute.setMaximum(6000)
+        self.spinBox_prefetchTilesPerMinute.setSingleStep(60)
+        self.spinBox_prefetchTilesPerMinute.setObjectName(_fromUtf8("spinBox_prefetchTilesPerMinute"))
+        self.formLayout.setWidget(6, QtGui.QFormLayout.FieldRole, self.spinBox_prefetchTilesPerMinute)
+        self.label_8 = QtGui.QLabel(Dialog)
+        self.label_8.setObjectName(_fromUtf8("label_8"))
+        self.formLayout.setWidget(7, QtGui.QFormLayout.LabelRole, self.label_8)
+        self.spinBox_maxRetries = QtGui.QSpinBox(Dialog)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.spinBox_maxRetries.sizePolicy().hasHeightForWidth())
+        self.spinBox_maxRetries.setSizePolicy(sizePolicy)
+        self.spinBox_maxRetries.setMinimumSize(QtCore.QSize(50, 0))
+        self.spinBox_maxRetries.setMaximum(10)
+        self.spinBox_maxRetries.setSingleStep(1)
+        self.spinBox_maxRetries.setObjectName(_fromUtf8("spinBox_maxRetries"))
+        self.formLayout.setWidget(7, QtGui.QFormLayout.FieldRole, self.spinBox_maxRetries)
+        self.label_9 = QtGui.QLabel(Dialog)
+        self.label_9.setObjectName(_fromUtf8("label_9"))
+        self.formLayout.setWidget(8, QtGui.QFormLayout.LabelRole, self.label_9)
+        self.spinBox_negativeCacheTTL = QtGui.QSpinBox(Dialog)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.spinBox_negativeCacheTTL.sizePolicy().hasHeightForWidth())
+        self.spinBox_negativeCacheTTL.setSizePolicy(sizePolicy)
+        self.spinBox_negativeCacheTTL.setMinimumSize(QtCore.QSize(50, 0))
+        self.spinBox_negativeCacheTTL.setMaximum(10080)
+        self.spinBox_negativeCacheTTL.setSingleStep(30)
+        self.spinBox_negativeCacheTTL.setObjectName(_fromUtf8("spinBox_negativeCacheTTL"))
+        self.formLayout.setWidget(8, QtGui.QFormLayout.FieldRole, self.spinBox_negativeCacheTTL)
+        self.label_10 = QtGui.QLabel(Dialog)
+        self.label_10.setObjectName(_fromUtf8("label_10"))
+        self.formLayout.setWidget(9, QtGui.QFormLayout.LabelRole, self.label_10)
+        self.spinBox_decodeThreads = QtGui.QSpinBox(Dialog)
+        sizePolicy = QtGui.QSizePolicy(QtGui.QSizePolicy.Fixed, QtGui.QSizePolicy.Fixed)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.spinBox_decodeThreads.sizePolicy().hasHeightForWidth())
+        self.spinBox_decodeThreads.setSizePolicy(sizePolicy)
+        self.spinBox_decodeThreads.setMinimumSize(QtCore.QSize(50, 0))
+        self.spinBox_decodeThreads.setMaximum(32)
+        self.spinBox_decodeThreads.setSingleStep(1)
+        self.spinBox_decodeThreads.setObjectName(_fromUtf8("spinBox_decodeThreads"))
+        self.formLayout.setWidget(9, QtGui.QFormLayout.FieldRole, self.spinBox_decodeThreads)
+        self.label_11 = QtGui.QLabel(Dialog)
+        self.label_11.setObjectName(_fromUtf8("label_11"))
+        self.formLayout.setWidget(10, QtGui.QFormLayout.LabelRole, self.label_11)
+        self.comboBox_drawMethod = QtGui.QComboBox(Dialog)
+        self.comboBox_drawMethod.setObjectName(_fromUtf8("comboBox_drawMethod"))
+        self.comboBox_drawMethod.addItem(_fromUtf8(""))
+        self.comboBox_drawMethod.addItem(_fromUtf8(""))
+        self.comboBox_drawMethod.addItem(_fromUtf8(""))
+        self.formLayout.setWidget(10, QtGui.QFormLayout.FieldRole, self.comboBox_drawMethod)
+        self.label_12 = QtGui.QLabel(Dialog)
+        self.label_12.setObjectName(_fromUtf8("label_12"))
+        self.formLayout.setWidget(11, QtGui.QFormLayout.LabelRole, self.label_12)
+        self.comboBox_zoomPolicy = QtGui.QComboBox(Dialog)
+        self.comboBox_zoomPolicy.setObjectName(_fromUtf8("comboBox_zoomPolicy"))
+        self.comboBox_zoomPolicy.addItem(_fromUtf8(""))
+        self.comboBox_zoomPolicy.addItem(_fromUtf8(""))
+        self.comboBox_zoomPolicy.addItem(_fromUtf8(""))
+        self.comboBox_zoomPolicy.addItem(_fromUtf8(""))
+        self.formLayout.setWidget(11, QtGui.QFormLayout.FieldRole, self.comboBox_zoomPolicy)
         self.verticalLayout.addLayout(self.formLayout)
         self.checkBox_MoveToLayer = QtGui.QCheckBox(Dialog)
         self.checkBox_MoveToLayer.setObjectName(_fromUtf8("checkBox_MoveToLayer"))
@@ -66,6 +197,15 @@ class Ui_Dialog(object):
         self.checkBox_NavigationMessages = QtGui.QCheckBox(Dialog)
         self.checkBox_NavigationMessages.setObjectName(_fromUtf8("checkBox_NavigationMessages"))
         self.verticalLayout.addWidget(self.checkBox_NavigationMessages)
+        self.checkBox_FallbackToChildren = QtGui.QCheckBox(Dialog)
+        self.checkBox_FallbackToChildren.setObjectName(_fromUtf8("checkBox_FallbackToChildren"))
+        self.verticalLayout.addWidget(self.checkBox_FallbackToChildren)
+        self.checkBox_ProgressiveRendering = QtGui.QCheckBox(Dialog)
+        self.checkBox_ProgressiveRendering.setObjectName(_fromUtf8("checkBox_ProgressiveRendering"))
+        self.verticalLayout.addWidget(self.checkBox_ProgressiveRendering)
+        self.checkBox_DpiAwareZoom = QtGui.QCheckBox(Dialog)
+        self.checkBox_DpiAwareZoom.setObjectName(_fromUtf8("checkBox_DpiAwareZoom"))
+        self.verticalLayout.addWidget(self.checkBox_DpiAwareZoom)
         self.buttonBox = QtGui.QDialogButtonBox(Dialog)
         self.buttonBox.setOrientation(QtCore.Qt.Horizontal)
         self.buttonBox.setStandardButtons(QtGui.QDialogButtonBox.Cancel|QtGui.QDialogButtonBox.Ok)
@@ -83,6 +223,26 @@ class Ui_Dialog(object):
         self.label.setText(_translate("Dialog", "External layer definition directory", None))
         self.toolButton_externalDirectory.setText(_translate("Dialog", "...", None))
         self.label_2.setText(_translate("Dialog", "Download time-out (sec)", None))
+        self.label_3.setText(_translate("Dialog", "Memory cache size (MB)", None))
+        self.label_4.setText(_translate("Dialog", "Decoded image cache size (MB)", None))
+        self.label_5.setText(_translate("Dialog", "Disk cache size per layer (MB)", None))
+        self.label_6.setText(_translate("Dialog", "Max zoom levels to look up a cached parent tile", None))
+        self.label_7.setText(_translate("Dialog", "Prefetch tiles per minute (0: disabled)", None))
+        self.label_8.setText(_translate("Dialog", "Retries of failed requests", None))
+        self.label_9.setText(_translate("Dialog", "Missing tile cache TTL (minutes)", None))
+        self.label_10.setText(_translate("Dialog", "Tile decoding threads (0: decode in render thread)", None))
+        self.label_11.setText(_translate("Dialog", "Tile drawing method (EPSG:3857, no rotation)", None))
+        self.comboBox_drawMethod.setItemText(0, _translate("Dialog", "Automatic", None))
+        self.comboBox_drawMethod.setItemText(1, _translate("Dialog", "Mosaic image", None))
+        self.comboBox_drawMethod.setItemText(2, _translate("Dialog", "Each tile directly", None))
+        self.label_12.setText(_translate("Dialog", "Zoom level selection", None))
+        self.comboBox_zoomPolicy.setItemText(0, _translate("Dialog", "Round up (sharpest)", None))
+        self.comboBox_zoomPolicy.setItemText(1, _translate("Dialog", "Nearest", None))
+        self.comboBox_zoomPolicy.setItemText(2, _translate("Dialog", "Round down (fewest tiles)", None))
+        self.comboBox_zoomPolicy.setItemText(3, _translate("Dialog", "Fewest downloads", None))
         self.checkBox_MoveToLayer.setText(_translate("Dialog", "Move plugin to Layer menu/toolbar", None))
         self.checkBox_NavigationMessages.setText(_translate("Dialog", "Display navigation messages", None))
+        self.checkBox_FallbackToChildren.setText(_translate("Dialog", "Fill loading tiles with cached child tiles", None))
+        self.checkBox_ProgressiveRendering.setText(_translate("Dialog", "Draw tiles progressively as they arrive (map canvas only)", None))
+        self.checkBox_DpiAwareZoom.setText(_translate("Dialog", "Select zoom level for 96 dpi on high-DPI screens and in printing", None))
 